@@ -0,0 +1,289 @@
+
+# The model servers player_ranker can prompt, behind one interface
+# Every backend has:
+#   generate(model, prompt, keep_alive, options): one response, a dictionary-like object with 'response',
+#       'done' and the token counts and durations Ollama reports (prompt_eval_count, eval_count, eval_duration, total_duration)
+#   generate_batch(model, prompts, ...): a list of responses, one per prompt
+#   stream(model, prompt, ...): an iterator of response chunks, closing it cancels the generation
+#   agenerate / agenerate_batch: the async versions of generate and generate_batch
+#   model_digest, pull, context_length, loaded_models: what the server knows about its models
+#   close / aclose: release the connections (aclose from the event loop that called agenerate)
+# OllamaBackend talks to an Ollama server, FakeBackend answers in process (for benchmarks and offline runs)
+
+# usage: backend = make_backend('fake', latency=0.1)
+
+## imports ##
+import re
+import time
+import random
+import hashlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import prompt_builder
+
+local_host = 'http://localhost:11434'
+
+
+# The interface every backend provides
+# a backend that answers a whole batch in one call sets supports_batch, so callers can send it many prompts at once
+class Backend(ABC):
+    supports_batch = False
+
+    @abstractmethod
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        pass
+
+    @abstractmethod
+    def stream(self, model_name, prompt, keep_alive=None, options=None):
+        pass
+
+    # sends the prompts at the same time (one thread each, up to `workers`), returns the responses in order
+    def generate_batch(self, model_name, prompts, keep_alive=None, options=None, workers=8):
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(prompts)))) as executor:
+            return list(executor.map(lambda prompt: self.generate(model_name, prompt, keep_alive, options), prompts))
+
+    async def agenerate(self, model_name, prompt, keep_alive=None, options=None):
+        import asyncio
+        return await asyncio.to_thread(self.generate, model_name, prompt, keep_alive, options)
+
+    async def agenerate_batch(self, model_name, prompts, keep_alive=None, options=None):
+        import asyncio
+        return list(await asyncio.gather(*(self.agenerate(model_name, prompt, keep_alive, options) for prompt in prompts)))
+
+    # returns the digest of the installed model, or None if it is not installed
+    def model_digest(self, model_name):
+        return None
+
+    def pull(self, model_name):
+        pass
+
+    # returns the context window (num_ctx) the server runs the model with, in tokens
+    def context_length(self, model_name):
+        return prompt_builder.default_context_tokens
+
+    # returns the names of the models the server has loaded right now
+    def loaded_models(self):
+        return []
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+# ollama names models without a tag '<name>:latest'
+def full_model_name(model_name):
+    return model_name if ':' in model_name else model_name + ':latest'
+
+
+# An Ollama server (pip install -U ollama, then run `ollama serve`)
+# requests share one pool of up to pool_size kept-alive HTTP connections, so each prompt skips the connection setup
+class OllamaBackend(Backend):
+    def __init__(self, host=local_host, timeout=120, pool_size=8):
+        import httpx
+        import ollama
+        self.host = host
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60)
+        self.client = ollama.Client(host=host, timeout=timeout, limits=self.limits)
+        self.async_client = None # made on first use, inside the event loop that uses it
+
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        return self.client.generate(model_name, prompt, keep_alive=keep_alive, options=options)
+
+    def stream(self, model_name, prompt, keep_alive=None, options=None):
+        return self.client.generate(model_name, prompt, stream=True, keep_alive=keep_alive, options=options)
+
+    async def agenerate(self, model_name, prompt, keep_alive=None, options=None):
+        if self.async_client is None:
+            import ollama
+            self.async_client = ollama.AsyncClient(host=self.host, timeout=self.timeout, limits=self.limits)
+        return await self.async_client.generate(model_name, prompt, keep_alive=keep_alive, options=options)
+
+    def model_digest(self, model_name):
+        model_name = full_model_name(model_name)
+        try:
+            models = self.client.list()['models']
+        except Exception as e:
+            print(f"Could not list models: {e}")
+            return None
+        for model in models:
+            if model['model'] == model_name:
+                return model['digest']
+        return None
+
+    def pull(self, model_name):
+        self.client.pull(model_name)
+
+    # a model can set its own num_ctx in its parameters, otherwise the server's default is used
+    def context_length(self, model_name):
+        try:
+            parameters = self.client.show(model_name).get('parameters') or ''
+        except Exception as e:
+            print(f"Could not read the model's parameters: {e}")
+            parameters = ''
+        for line in parameters.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == 'num_ctx':
+                return int(fields[1])
+        return super().context_length(model_name)
+
+    def loaded_models(self):
+        try:
+            return [model['model'] for model in self.client.ps()['models']]
+        except Exception as e:
+            print(f"Could not list loaded models: {e}")
+            return []
+
+    # closes the async client in the event loop that used it (call it from that loop before it ends)
+    async def aclose(self):
+        if self.async_client is not None:
+            async_client, self.async_client = self.async_client, None
+            await async_client.close()
+
+    # closes both clients; an async client that was not closed with aclose is closed in a new event loop
+    def close(self):
+        self.client.close()
+        if self.async_client is not None:
+            import asyncio
+            try:
+                asyncio.run(self.aclose())
+            except Exception as e:
+                print(f"Could not close the async client: {e}")
+
+
+# returns a ranking answer in the format asked for by player_ranker.prompt_maker
+# the players are ranked in the order the prompt lists them
+def stub_answer(prompt):
+    players = []
+    for line in prompt.split("\n"):
+        line = line.strip()
+        if line.startswith("The players are: "):
+            players = line.replace("The players are: ", "").split(", ")
+    mafia = players[0] if players else 'none'
+    return "Session: 1\nRank:\n" + "\n".join(players) + f"\n\nActualy likely to be Mafia: {mafia}"
+
+# returns the explanation a talkative model adds after its answer, `words` words long
+def stub_ramble(words):
+    if not words:
+        return ''
+    return "\n\nExplanation:\n" + " ".join("reasoning" for _ in range(words))
+
+# splits an answer into the pieces it is streamed in (each word with the white space after it)
+def stub_tokens(text):
+    return re.findall(r'\s+|\S+\s*', text)
+
+
+# An in-process stand-in for a model server, with no network and no GPU
+# Each prompt takes `latency` seconds plus `token_latency` seconds per word of the answer, and a batch of prompts
+# takes as long as its longest prompt, like a server that runs the batch together
+# outputs decides the answers: a function of the prompt, a dictionary of prompt -> answer, or None for the answer
+# stub_answer gives (players in the order the prompt lists them, the first as Mafia)
+# with shuffle=True the players are ranked in a random order instead, which depends only on the prompt and the seed
+# (options={'seed': n} overrides the seed), so the same request always gets the same answer
+# with noise set as well, the order is stub_answer's moved about instead of shuffled: each player's place gets
+# random noise with a standard deviation of `noise` places (scaled by options['temperature'] / 0.8, Ollama's default)
+class FakeBackend(Backend):
+    supports_batch = True
+
+    def __init__(self, latency=0.0, token_latency=0.0, outputs=None, ramble=0, shuffle=False, seed=0, noise=None, context_tokens=prompt_builder.default_context_tokens):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.outputs = outputs
+        self.ramble = ramble
+        self.shuffle = shuffle
+        self.seed = seed
+        self.noise = noise
+        self.context_tokens = context_tokens
+
+    # returns the answer to a prompt
+    def answer(self, prompt, options=None):
+        if callable(self.outputs):
+            answer = self.outputs(prompt)
+        elif self.outputs is not None:
+            answer = self.outputs[prompt]
+        else:
+            answer = stub_answer(prompt)
+            if self.shuffle:
+                seed = (options or {}).get('seed', self.seed)
+                rng = random.Random(hashlib.sha256(f"{seed}\n{prompt}".encode()).digest())
+                lines = answer.split('\n')
+                rank_start, rank_end = lines.index('Rank:') + 1, lines.index('')
+                ranked = lines[rank_start:rank_end]
+                if self.noise is None:
+                    rng.shuffle(ranked)
+                else:
+                    spread = self.noise * (options or {}).get('temperature', 0.8) / 0.8
+                    places = [place + rng.gauss(0, spread) for place in range(len(ranked))]
+                    ranked = [name for place, name in sorted(zip(places, ranked))]
+                answer = '\n'.join(lines[:rank_start] + ranked + lines[rank_end:-1] + [f"Actualy likely to be Mafia: {ranked[0] if ranked else 'none'}"])
+        return answer + stub_ramble(self.ramble)
+
+    # returns the response (like Ollama's) to a prompt and the seconds it should take
+    def respond(self, prompt, options=None):
+        answer = self.answer(prompt, options)
+        tokens = len(stub_tokens(answer))
+        seconds = self.latency + self.token_latency * tokens
+        return {
+            'response': answer,
+            'done': True,
+            'prompt_eval_count': len(prompt.split()),
+            'eval_count': tokens,
+            'eval_duration': int((self.token_latency * tokens or self.latency) * 1e9),
+            'total_duration': int(seconds * 1e9),
+        }, seconds
+
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        response, seconds = self.respond(prompt, options)
+        time.sleep(seconds)
+        return response
+
+    def generate_batch(self, model_name, prompts, keep_alive=None, options=None, workers=8):
+        responses = [self.respond(prompt, options) for prompt in prompts]
+        time.sleep(max((seconds for response, seconds in responses), default=0.0))
+        return [response for response, seconds in responses]
+
+    def stream(self, model_name, prompt, keep_alive=None, options=None):
+        answer = self.answer(prompt, options)
+        tokens = stub_tokens(answer)
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        for token in tokens:
+            time.sleep(self.token_latency)
+            yield {'response': token, 'done': False}
+        duration = int((time.perf_counter() - start) * 1e9)
+        yield {'response': '', 'done': True, 'prompt_eval_count': len(prompt.split()), 'eval_count': len(tokens),
+               'eval_duration': duration, 'total_duration': duration}
+
+    async def agenerate(self, model_name, prompt, keep_alive=None, options=None):
+        import asyncio
+        response, seconds = self.respond(prompt, options)
+        await asyncio.sleep(seconds)
+        return response
+
+    def model_digest(self, model_name):
+        return hashlib.sha256(full_model_name(model_name).encode()).hexdigest()
+
+    def context_length(self, model_name):
+        return self.context_tokens
+
+
+# the Ollama backend at local_host, made the first time it is needed
+_default_backend = None
+def default_backend():
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = OllamaBackend()
+    return _default_backend
+
+# backends by name, for the command lines
+backend_types = {
+    'ollama': OllamaBackend,
+    'fake': FakeBackend,
+}
+
+# returns a backend by name, made with the given settings
+def make_backend(name='ollama', **settings):
+    if name not in backend_types:
+        raise ValueError(f"Unknown backend '{name}', expected one of {list(backend_types)}")
+    return backend_types[name](**settings)
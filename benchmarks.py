@@ -0,0 +1,260 @@
+
+# Benchmarks of the whole build, rank and grade pipeline on synthetic Mafia datasets
+# A synthetic dataset repeats every session of dataset/ `scale` times (the files are hard linked, not copied),
+# and the model is backends.FakeBackend, so the times measured are this code's own and not a model server's
+# For each scale the pipeline runs once from an empty transcripts folder, and the spans, counters and observations
+# it records (see instrumentation.py) are written to <out>/bench_<scale>x.json and .csv
+# Given the results folder of an earlier run with --baseline, each span's total time is compared with the one before it,
+# and the script exits with an error when any is slower by more than --tolerance
+# With --enlarge, the transcript formatting is benchmarked instead, on datasets whose info.csv files repeat every chat
+# and vote row: transcript_maker.line_table against the row by row formatting it replaced (reference_lines), which must
+# give the same lines byte for byte, and the whole extraction of every round (transcript_maker.extract_rounds)
+# The stages are benchmarked one by one with pytest-benchmark in tests/test_benchmarks.py, on the same synthetic datasets
+
+# usage: python benchmarks.py --scales 10 100 1000 --out bench_results
+#        python benchmarks.py --scales 10 --baseline bench_results --tolerance 0.2
+#        python benchmarks.py --scales 100 --profile cprofile
+#        python benchmarks.py --enlarge 50 200
+
+## imports ##
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import backends
+import pipeline
+import instrumentation
+import transcript_maker
+
+
+# builds a dataset in folder that has every session of source `scale` times, and returns how many sessions it has
+# a folder built before for the same scale is used as it is
+def synthetic_dataset(source=transcript_maker.dataset_folder, scale=10, folder='synthetic_dataset'):
+    sessions = transcript_maker.session_directories(source)
+    marker = os.path.join(folder, 'scale.txt')
+    if os.path.exists(marker):
+        with open(marker) as marker_file:
+            if marker_file.read().strip() == str(scale):
+                return len(sessions) * scale
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+    for copy in range(scale):
+        for session in sessions:
+            target = os.path.join(folder, f"{os.path.basename(session)}-{copy}")
+            os.makedirs(target, exist_ok=True)
+            for file_name in os.listdir(session):
+                source_file = os.path.join(session, file_name)
+                if not os.path.isfile(source_file):
+                    continue
+                try:
+                    os.link(source_file, os.path.join(target, file_name))
+                except OSError:
+                    shutil.copy2(source_file, os.path.join(target, file_name))
+    with open(marker, 'w') as marker_file:
+        marker_file.write(str(scale))
+    return len(sessions) * scale
+
+# builds a dataset in folder with the sessions of source, where every chat and vote row of each info.csv is there `scale` times
+# the copies of a row are timed between it and the row after it, so they sort right after it and stay in its phase
+# (the sessions grow longer, not more numerous as in synthetic_dataset), and a folder built before for the same scale is used as it is
+def enlarged_dataset(source=transcript_maker.dataset_folder, scale=50, folder='enlarged_dataset'):
+    import numpy as np
+    import pandas as pd
+    marker = os.path.join(folder, 'scale.txt')
+    if os.path.exists(marker):
+        with open(marker) as marker_file:
+            if marker_file.read().strip() == str(scale):
+                return folder
+        shutil.rmtree(folder)
+    for session in transcript_maker.session_directories(source):
+        target = os.path.join(folder, os.path.basename(session))
+        os.makedirs(target, exist_ok=True)
+        shutil.copy2(os.path.join(session, 'node.csv'), os.path.join(target, 'node.csv'))
+        data = pd.read_csv(os.path.join(session, 'info.csv'))
+        data = data.sort_values(by='creation_time', ignore_index=True)
+        times = pd.to_datetime(data['creation_time'], format='mixed')
+        gaps = (times.shift(-1) - times).fillna(pd.Timedelta(seconds=1))
+        spoken = data['type'].isin(['text', 'vote']).to_numpy()
+        copies = np.where(spoken, scale, 1)
+        enlarged = data.loc[data.index.repeat(copies)].reset_index(drop=True)
+        # copy k of a row is k / scale of the way to the next row
+        step = np.concatenate([np.arange(count) for count in copies]) / np.repeat(copies, copies)
+        offsets = (gaps.to_numpy().repeat(copies) * step).astype('timedelta64[us]')
+        enlarged['creation_time'] = (times.to_numpy().repeat(copies) + offsets).astype('datetime64[us]').astype(str)
+        enlarged['creation_time'] = enlarged['creation_time'].str.replace('T', ' ')
+        enlarged.to_csv(os.path.join(target, 'info.csv'), index=False)
+    with open(marker, 'w') as marker_file:
+        marker_file.write(str(scale))
+    return folder
+
+# the (regular, anonymized) transcript lines of session data, formatted one row at a time
+# as transcript_maker did before line_table (which must give the same lines)
+def reference_lines(session_data, aliases):
+    transcript_lines = []
+    anonymized_lines = []
+    for _, row in session_data.iterrows():
+        # every vote is saved as "{player_voting} votes for {player_voted}!"
+        if row['type'] == 'vote':
+            try:
+                player_voting, player_voted = row['contents'].split(': ')
+                formatted_content = f"{player_voting} votes for {player_voted}!"
+                anonymized_content = f"{aliases.get(player_voting, 'silent_player')} votes for {aliases.get(player_voted, 'silent_player')}!"
+            except ValueError:
+                formatted_content = anonymized_content = row['contents']
+        # every chat message is saved as "{player}: {message}"
+        elif row['type'] == 'text':
+            try:
+                player, message = row['contents'].split(': ', 1)
+                formatted_content = f"{player}: {message}"
+                anonymized_content = f"{aliases.get(player, player)}: {message}"
+            except ValueError:
+                formatted_content = anonymized_content = row['contents']
+        # Use original content for other types
+        else:
+            formatted_content = anonymized_content = row['contents']
+        transcript_lines.append(formatted_content)
+        anonymized_lines.append(anonymized_content)
+    return transcript_lines, anonymized_lines
+
+# times the transcript formatting on an enlarged dataset of each scale (and on the dataset itself, as scale 1)
+# returns a list of results, one per scale: the scale, rows formatted, seconds of reference_lines and of line_table,
+# whether they gave the same lines, and the seconds transcript_maker.extract_rounds took for every round of every session
+def extraction_benchmark(scales=(50, 200), data_folder='synthetic_data', source=transcript_maker.dataset_folder):
+    import pandas as pd
+    results = []
+    for scale in (1,) + tuple(scales):
+        folder = source if scale == 1 else enlarged_dataset(source, scale, os.path.join(data_folder, f"enlarged_{scale}x"))
+        sessions = transcript_maker.session_directories(folder)
+        logs = [pd.read_csv(os.path.join(session, 'info.csv')).sort_values(by='creation_time') for session in sessions]
+        names = [transcript_maker.generate_names(log) for log in logs]
+
+        start = time.perf_counter()
+        reference = [reference_lines(log, aliases) for log, aliases in zip(logs, names)]
+        reference_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        tables = [transcript_maker.line_table(log, aliases) for log, aliases in zip(logs, names)]
+        seconds = time.perf_counter() - start
+        same = all(table['line'].tolist() == lines and table['anonymized_line'].tolist() == anonymized
+                   for table, (lines, anonymized) in zip(tables, reference))
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for number, session in enumerate(sessions, 1):
+                for extracted in transcript_maker.extract_rounds(session, number, seed=number):
+                    pass
+        extract_seconds = time.perf_counter() - start
+        results.append({'scale': scale, 'rows': sum(len(log) for log in logs), 'reference_seconds': reference_seconds,
+                        'line_table_seconds': seconds, 'same_lines': same, 'extract_seconds': extract_seconds})
+        print(f"{scale}x: {results[-1]['rows']} rows, row by row {reference_seconds:.2f}s, line_table {seconds:.2f}s "
+              f"({reference_seconds / seconds:.1f}x), same lines: {same}, extract_rounds {extract_seconds:.2f}s")
+    return results
+
+# runs the pipeline once on a synthetic dataset of the given scale and returns the results:
+# the scale, sessions, transcripts ranked, wall-clock seconds, seconds of each pipeline stage and instrumentation.summary()
+# the pipeline's own prints are hidden unless verbose
+def run_benchmark(scale, data_folder, workers=4, extract_workers=1, latency=0.0, profile=None, profile_path=None, verbose=False):
+    sessions = synthetic_dataset(scale=scale, folder=os.path.join(data_folder, f"dataset_{scale}x"))
+    with tempfile.TemporaryDirectory() as transcripts_folder:
+        instrumentation.reset()
+        backend = backends.FakeBackend(latency=latency)
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with output, instrumentation.profile(profile, profile_path):
+            metrics, summary, times = pipeline.run_pipeline('fake', os.path.join(data_folder, f"dataset_{scale}x"), transcripts_folder,
+                                                            workers=workers, extract_workers=extract_workers, backend=backend,
+                                                            cache=None, pull=False)
+        seconds = time.perf_counter() - start
+    report = instrumentation.summary()
+    return {
+        'scale': scale,
+        'sessions': sessions,
+        'transcripts': report['counters'].get('transcripts written', 0),
+        'seconds': seconds,
+        'stages': times,
+        **report,
+    }
+
+# returns the spans of results whose total time grew by more than tolerance (a fraction) over the baseline's,
+# as (span, baseline seconds, seconds), with the whole run as the span 'total'
+# spans that took less than min_seconds in the baseline are too short to compare
+def regressions(results, baseline, tolerance=0.2, min_seconds=0.05):
+    slower = []
+    pairs = [('total', baseline['seconds'], results['seconds'])]
+    pairs += [(name, row['total'], results['spans'][name]['total']) for name, row in baseline['spans'].items() if name in results['spans']]
+    for name, before, now in pairs:
+        if before >= min_seconds and now > before * (1 + tolerance):
+            slower.append((name, before, now))
+    return slower
+
+# runs the benchmark for each scale, writes the results to out and compares them with the baseline folder (if given)
+# returns the regressions found, by scale
+def benchmark(scales=(10, 100, 1000), out='bench_results', baseline=None, tolerance=0.2, min_seconds=0.05,
+              data_folder='synthetic_data', workers=4, extract_workers=1, latency=0.0, profile=None, verbose=False):
+    os.makedirs(out, exist_ok=True)
+    found = {}
+    for scale in scales:
+        profile_path = None
+        if profile is not None:
+            profile_path = os.path.join(out, f"bench_{scale}x." + ('prof' if profile == 'cprofile' else 'html'))
+        results = run_benchmark(scale, data_folder, workers, extract_workers, latency, profile, profile_path, verbose)
+        with open(os.path.join(out, f"bench_{scale}x.json"), 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        instrumentation.export_csv(os.path.join(out, f"bench_{scale}x.csv"))
+
+        print(f"\n{scale}x: {results['sessions']} sessions, {results['transcripts']} transcripts in {results['seconds']:.2f}s "
+              f"({results['transcripts'] / results['seconds']:.1f} transcripts/s)")
+        instrumentation.print_summary()
+
+        if baseline is not None:
+            baseline_file = os.path.join(baseline, f"bench_{scale}x.json")
+            if not os.path.exists(baseline_file):
+                print(f"No baseline for {scale}x in {baseline}")
+                continue
+            with open(baseline_file) as input_file:
+                slower = regressions(results, json.load(input_file), tolerance, min_seconds)
+            for name, before, now in slower:
+                print(f"  REGRESSION {name}: {before:.3f}s -> {now:.3f}s (+{(now / before - 1) * 100:.0f}%)")
+            if slower:
+                found[scale] = slower
+    return found
+
+
+# command line usage: see the top of this file, or python mafia_eval.py bench --scales 10
+command_description = "Benchmark the pipeline on synthetic datasets with a fake model"
+
+def add_arguments(parser):
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000], help="times to repeat dataset/")
+    parser.add_argument('--out', default='bench_results', help="folder for the JSON and CSV results")
+    parser.add_argument('--baseline', default=None, help="results folder of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="fraction a span may slow down before it is a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="spans shorter than this in the baseline are not compared")
+    parser.add_argument('--data-folder', default='synthetic_data', help="where the synthetic datasets are built (and kept)")
+    parser.add_argument('--workers', type=int, default=4, help="rank threads of the pipeline")
+    parser.add_argument('--extract-workers', type=int, default=1, help="extract processes (their spans are not recorded)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake model takes per prompt")
+    parser.add_argument('--profile', default=None, choices=['cprofile', 'pyinstrument'], help="profile each run too")
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's prints")
+    parser.add_argument('--enlarge', type=int, nargs='+', default=None,
+                        help="benchmark the transcript formatting on info.csv files with every chat and vote row this many times instead")
+
+# exits with an error if a regression was found (or, with --enlarge, if line_table's lines differ from the reference)
+def run_command(args):
+    if args.enlarge:
+        os.makedirs(args.out, exist_ok=True)
+        results = extraction_benchmark(tuple(args.enlarge), args.data_folder)
+        with open(os.path.join(args.out, 'extraction.json'), 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        sys.exit(0 if all(result['same_lines'] for result in results) else 1)
+    found = benchmark(tuple(args.scales), args.out, args.baseline, args.tolerance, args.min_seconds, args.data_folder, args.workers,
+                      args.extract_workers, args.latency, args.profile, args.verbose)
+    sys.exit(1 if found else 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=command_description)
+    add_arguments(parser)
+    run_command(parser.parse_args())
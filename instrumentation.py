@@ -0,0 +1,177 @@
+
+# Timers, counters and spans for seeing where the time goes
+# Code marks its steps with spans:
+#   with instrumentation.span('csv load'):
+#       data = pd.read_csv(path)
+# counts events with count('cache hits') and records sizes with observe('prompt tokens', n)
+# Everything is kept in memory (for this process) until exported with export_json / export_csv
+# spans recorded in worker processes (such as transcript_maker's process pool) stay in those processes
+# A run can also be profiled (cProfile, or pyinstrument if installed) with the profile context manager
+
+## imports ##
+import csv
+import json
+import time
+import threading
+import contextlib
+from functools import wraps
+
+enabled = True
+spans = [] # (name, parent, start, seconds, thread) of every finished span
+counters = {} # name -> running total
+observations = {} # name -> list of recorded values
+lock = threading.Lock()
+local = threading.local() # the open spans of each thread
+start_time = time.perf_counter()
+
+
+# times the code inside it as a span called name
+# a span opened inside another one (on the same thread) records it as its parent
+@contextlib.contextmanager
+def span(name):
+    if not enabled:
+        yield
+        return
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stack.pop()
+        with lock:
+            spans.append((name, parent, started - start_time, seconds, threading.current_thread().name))
+
+# decorator that records every call of a function as a span (named after the function unless a name is given)
+def timed(name=None):
+    def decorate(function):
+        span_name = name or function.__name__
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+# adds amount to the counter called name
+def count(name, amount=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + amount
+
+# records a value (such as a size) under name
+def observe(name, value):
+    if enabled:
+        with lock:
+            observations.setdefault(name, []).append(value)
+
+# forgets everything recorded so far
+def reset():
+    global start_time
+    with lock:
+        spans.clear()
+        counters.clear()
+        observations.clear()
+        start_time = time.perf_counter()
+
+# returns the value at quantile q (0 to 1) of a sorted list
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# returns a summary of what was recorded:
+#   spans: by name, how many, their total, mean, median, 95th percentile and longest seconds
+#   counters: the counter totals
+#   observations: by name, how many, their total, mean, median, 95th percentile and largest value
+def summary():
+    with lock:
+        span_times = {}
+        for name, parent, started, seconds, thread in spans:
+            span_times.setdefault(name, []).append(seconds)
+        values = {name: list(recorded) for name, recorded in observations.items()}
+        totals = dict(counters)
+
+    def describe(recorded):
+        recorded = sorted(recorded)
+        return {'count': len(recorded), 'total': sum(recorded), 'mean': sum(recorded) / len(recorded),
+                'p50': quantile(recorded, 0.5), 'p95': quantile(recorded, 0.95), 'max': recorded[-1]}
+    return {
+        'spans': {name: describe(seconds) for name, seconds in span_times.items()},
+        'counters': totals,
+        'observations': {name: describe(recorded) for name, recorded in values.items() if recorded},
+    }
+
+# writes the summary, and every span unless spans_too=False, to a JSON file
+def export_json(path, spans_too=True):
+    report = summary()
+    if spans_too:
+        with lock:
+            report['span_log'] = [{'name': name, 'parent': parent, 'start': started, 'seconds': seconds, 'thread': thread}
+                                  for name, parent, started, seconds, thread in spans]
+    with open(path, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+# writes the summary to a CSV file, one row per span, counter and observation
+def export_csv(path):
+    report = summary()
+    fields = ['kind', 'name', 'count', 'total', 'mean', 'p50', 'p95', 'max']
+    with open(path, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=fields)
+        writer.writeheader()
+        for kind in ('spans', 'observations'):
+            for name, row in report[kind].items():
+                writer.writerow({'kind': kind[:-1], 'name': name, **row})
+        for name, total in report['counters'].items():
+            writer.writerow({'kind': 'counter', 'name': name, 'count': total})
+
+# profiles the code inside it and writes the profile to path (if given) when done
+#   tool='cprofile': a pstats file (read it with `python -m pstats path` or snakeviz)
+#   tool='pyinstrument': an HTML report (pip install pyinstrument)
+# tool=None does nothing, so callers can pass a command line option straight through
+@contextlib.contextmanager
+def profile(tool='cprofile', path=None):
+    if tool is None:
+        yield
+        return
+    if tool == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            if path is not None:
+                with open(path, 'w') as output_file:
+                    output_file.write(profiler.output_html())
+            else:
+                print(profiler.output_text())
+    elif tool == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if path is not None:
+                profiler.dump_stats(path)
+            else:
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        raise ValueError(f"Unknown profiler '{tool}', expected 'cprofile' or 'pyinstrument'")
+
+# prints the span summary as a table, slowest total first
+def print_summary():
+    report = summary()
+    print(f"{'span':<28}{'count':>8}{'total (s)':>12}{'mean (ms)':>12}{'p95 (ms)':>12}")
+    for name, row in sorted(report['spans'].items(), key=lambda item: -item[1]['total']):
+        print(f"{name:<28}{row['count']:>8}{row['total']:>12.3f}{row['mean'] * 1000:>12.2f}{row['p95'] * 1000:>12.2f}")
+    for name, total in report['counters'].items():
+        print(f"{name:<28}{total:>8}")
+    for name, row in report['observations'].items():
+        print(f"{name:<28}{row['count']:>8}  mean {row['mean']:.1f}, p95 {row['p95']}, max {row['max']}")
@@ -0,0 +1,50 @@
+
+# One command line for every step of the evaluation:
+#   build:    write the transcripts of the dataset (transcript_maker.py)
+#   rank:     rank the players of each transcript with a model (player_ranker.py)
+#   grade:    parse and grade a ranks file (rank_grader.py)
+#   pipeline: build, rank and grade in one pipelined run (pipeline.py)
+#   bench:    benchmark the pipeline on synthetic datasets (benchmarks.py)
+# Only the module of the command that is run gets imported (and pandas, numpy and ollama only when they are used),
+# so `--help` and quick commands start straight away
+# Each module keeps its own command line too: `python mafia_eval.py rank ...` is `python player_ranker.py ...`
+
+# usage: python mafia_eval.py build dataset transcripts_new
+#        python mafia_eval.py rank llama3.2 transcripts_new --workers 4
+#        python mafia_eval.py grade transcripts_new --metrics
+#        python mafia_eval.py bench --scales 10 --baseline bench_results
+
+## imports ##
+import sys
+import argparse
+import importlib
+
+# command -> (module, what it does)
+commands = {
+    'build': ('transcript_maker', "write the transcripts of every round of every game in the dataset"),
+    'rank': ('player_ranker', "rank the players in each transcript with a model"),
+    'grade': ('rank_grader', "parse and grade the ranks file of a transcripts folder"),
+    'pipeline': ('pipeline', "build, rank and grade the dataset in one pipelined run"),
+    'bench': ('benchmarks', "benchmark the pipeline on synthetic datasets with a fake model"),
+}
+
+
+# parses the command line (argv, without the program name) and runs the command
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(prog='mafia-eval', description="Build, rank and grade Mafia game transcripts")
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='command')
+    for name, (module_name, help_text) in commands.items():
+        command_parser = subparsers.add_parser(name, help=help_text)
+        # only the command being run has its module imported to fill in its options
+        if argv and argv[0] == name:
+            module = importlib.import_module(module_name)
+            command_parser.description = module.command_description
+            module.add_arguments(command_parser)
+            command_parser.set_defaults(run=module.run_command)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
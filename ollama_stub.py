@@ -0,0 +1,181 @@
+
+# A stand-in for the Ollama server, used to benchmark player_ranker without a GPU
+# Answers /api/generate (and /api/pull, /api/tags, /api/ps) like Ollama does, after a configurable delay
+# Switching to a different model costs an extra delay, like loading it onto the GPU would
+# Each word of an answer takes `token_latency` seconds, and answers can be followed by `ramble` words of explanation,
+# like a model that keeps talking after its answer. Streamed prompts ('stream': true) are answered a word at a time
+# Reading a prompt takes `prefill_latency` seconds per word, so long prompts take longer to answer
+
+# usage: python ollama_stub.py --latency 0.5 --workers 1 2 4 8
+#        python ollama_stub.py --latency 0.2 --token-latency 0.01 --ramble 200 --workers 4 [--stream]
+
+## imports ##
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from backends import stub_answer, stub_ramble, stub_tokens
+
+
+# returns a request handler class that waits `latency` seconds before answering a prompt
+# and `swap_latency` seconds more when the prompt is for a different model than the last one
+# answers take `token_latency` seconds per word and end with `ramble` words of explanation
+# and prompts take `prefill_latency` seconds per word to read
+# the handler class counts the words it has generated in `generated` (cut off answers stop counting when the client leaves)
+def make_handler(latency, swap_latency=0.0, token_latency=0.0, ramble=0, prefill_latency=0.0):
+    # imported here, so importing the module does not load the server
+    from http.server import BaseHTTPRequestHandler
+    pulled = set() # models 'installed' on this server
+    loaded = [] # the model currently 'on the GPU'
+    load_lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/api/tags':
+                models = [{'model': name, 'name': name, 'digest': hashlib.sha256(name.encode()).hexdigest()} for name in sorted(pulled)]
+                self.send_json({'models': models})
+            elif self.path == '/api/ps':
+                self.send_json({'models': [{'model': name, 'name': name} for name in loaded]})
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            if self.path == '/api/generate':
+                name = request.get('model', '')
+                name = name if ':' in name else name + ':latest'
+                with load_lock:
+                    if loaded != [name]:
+                        time.sleep(swap_latency) # pretend to load the model
+                        loaded[:] = [name]
+                time.sleep(latency + prefill_latency * len(request.get('prompt', '').split())) # pretend the model is thinking
+                answer = stub_answer(request.get('prompt', '')) + stub_ramble(ramble)
+                if request.get('stream'):
+                    self.send_stream(request, answer)
+                    return
+                # an answer that is not streamed takes as long as streaming all of it would
+                tokens = stub_tokens(answer)
+                time.sleep(token_latency * len(tokens))
+                with load_lock:
+                    StubHandler.generated += len(tokens)
+                body = {
+                    'model': request.get('model', ''),
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    'response': answer,
+                    'done': True,
+                    'prompt_eval_count': len(request.get('prompt', '').split()),
+                    'eval_count': len(answer.split()),
+                    'eval_duration': int((token_latency * len(tokens) or latency) * 1e9),
+                    'total_duration': int((latency + token_latency * len(tokens)) * 1e9),
+                }
+            elif self.path == '/api/pull':
+                name = request.get('model', '')
+                pulled.add(name if ':' in name else name + ':latest')
+                body = {'status': 'success'}
+            else:
+                self.send_error(404)
+                return
+            self.send_json(body)
+
+        # streams the answer as newline delimited JSON chunks, like Ollama does
+        # a client that closes the connection stops the answer, like cancelling a generation
+        def send_stream(self, request, answer):
+            start = time.perf_counter()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            tokens = stub_tokens(answer)
+            try:
+                for token in tokens:
+                    time.sleep(token_latency)
+                    self.wfile.write(json.dumps({'model': request.get('model', ''), 'response': token, 'done': False}).encode() + b'\n')
+                    self.wfile.flush()
+                    with load_lock:
+                        StubHandler.generated += 1
+                duration = int((time.perf_counter() - start) * 1e9)
+                self.wfile.write(json.dumps({
+                    'model': request.get('model', ''),
+                    'response': '',
+                    'done': True,
+                    'prompt_eval_count': len(request.get('prompt', '').split()),
+                    'eval_count': len(tokens),
+                    'eval_duration': duration,
+                    'total_duration': duration + int(latency * 1e9),
+                }).encode() + b'\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def send_json(self, body):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        # keep the benchmark output readable
+        def log_message(self, format, *args):
+            pass
+
+    StubHandler.generated = 0
+    return StubHandler
+
+# starts a stub server on a background thread
+# returns the server (call server.shutdown() when done) and its address
+def start_stub_server(latency=0.5, port=0, swap_latency=0.0, token_latency=0.0, ramble=0, prefill_latency=0.0):
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(latency, swap_latency, token_latency, ramble, prefill_latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Stub Ollama server running at {host} ({latency}s per prompt)")
+    return server, host
+
+# times player_ranker.ollama_rank against the stub server for each number of workers
+# the transcripts are copied to a temporary folder so the real ranks.txt is left alone
+# with stream=True the responses are streamed (and stopped early once ranked)
+def benchmark(transcripts_folder='transcripts_new', latency=0.5, worker_counts=(1, 2, 4, 8), limit=None, stream=False, token_latency=0.0, ramble=0):
+    import player_ranker
+
+    server, host = start_stub_server(latency, token_latency=token_latency, ramble=ramble)
+    results = {}
+    with tempfile.TemporaryDirectory() as bench_folder:
+        files = player_ranker.transcript_list(transcripts_folder)
+        if limit:
+            files = files[:limit]
+        for transcript_file in files:
+            shutil.copy(os.path.join(transcripts_folder, transcript_file), bench_folder)
+        print(f"Ranking {len(files)} transcripts")
+
+        for workers in worker_counts:
+            server.RequestHandlerClass.generated = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()): # silence the per-file prints
+                summary = player_ranker.ollama_rank('stub', bench_folder, workers=workers, host=host, cache=None, stream=stream)
+            results[workers] = time.perf_counter() - start
+            print(f"  workers={workers}: {results[workers]:.2f}s, speedup x{results[worker_counts[0]] / results[workers]:.2f}")
+            print(f"    words generated: {server.RequestHandlerClass.generated}, stopped early: {summary['stopped_early']}, "
+                  f"tokens/s: {summary['eval_tokens'] / summary['eval_seconds'] if summary['eval_seconds'] else 0.0:.1f}"
+                  + (f", first token: {summary['first_token_seconds']:.3f}s" if summary['first_token_seconds'] is not None else ''))
+    server.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark player_ranker against a stub Ollama server")
+    parser.add_argument('--folder', default='transcripts_new', help="transcripts folder to rank")
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds the stub waits per prompt")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="worker counts to compare")
+    parser.add_argument('--limit', type=int, default=None, help="only rank the first N transcripts")
+    parser.add_argument('--stream', action='store_true', help="stream the responses and stop them once ranked")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="seconds the stub takes per streamed word")
+    parser.add_argument('--ramble', type=int, default=0, help="words of explanation the stub adds after its answer")
+    args = parser.parse_args()
+    benchmark(args.folder, args.latency, tuple(args.workers), args.limit, args.stream, args.token_latency, args.ramble)
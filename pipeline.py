@@ -0,0 +1,328 @@
+
+# Builds, ranks and grades the dataset in one run, with every stage working at the same time
+# The stages are threads passing transcripts along bounded queues:
+#   extract: builds the transcripts of new and changed sessions (see transcript_maker.py) and passes on each
+#            transcript file as soon as it is written (sessions already up to date are passed on first)
+#   prompt: builds the prompts of each transcript (see player_ranker.prompt_maker)
+#   rank: `workers` threads prompting the model (responses saved in the response cache are used straight away)
+#   grade: journals each response and grades it as soon as it arrives (see rank_grader.py)
+# so the model starts on the first session while the rest are still being extracted, and the grades come out
+# while the model works. Each queue holds at most `queue_size` transcripts, so no stage runs far ahead of the next.
+# ranks.txt, ranks.jsonl and manifest.json are written to the transcripts folder as if the stages ran one by one.
+
+# usage: python pipeline.py llama3.2 --dataset dataset --transcripts transcripts --workers 4
+
+## imports ##
+import os
+import time
+import queue
+import argparse
+import threading
+from functools import partial
+from concurrent.futures import as_completed
+import backends
+import prompt_builder
+import rank_journal
+import instrumentation
+import rank_grader
+import player_ranker
+import transcript_maker
+
+# put on a queue after the last transcript
+end_of_queue = None
+
+
+# Runs the whole pipeline for one model (see the top of this file)
+# Optional inputs:
+#   workers: how many prompts may be waiting on the model at once
+#   extract_workers: sessions built in parallel processes (1 = built in the extract thread)
+#   queue_size: transcripts each queue holds before the stage feeding it waits
+#   force: rebuild every session's transcripts, not just the changed ones
+#   max_rounds: the rounds of each game to build transcripts of (None for all, see transcript_maker.process_transmissions)
+#   store_path: make the prompts from the transcripts in this session store (see session_store.ingest, which builds it
+#               from the same dataset) instead of reading the transcript files back
+#   backend, host, timeout, retries, backoff, cache, resume, stream, keep_alive, chunk, sampling, batch_size, ranks_name, pull:
+#       as for player_ranker.ollama_rank, whose player_ranker.ModelRanker ranks the prompts here too
+#       (the chunks of a transcript are sent together with backend.generate_batch)
+# returns (metrics, summary, times):
+#   metrics, summary: as rank_grader.grade returns them
+#   times: seconds each stage spent working (not waiting on its queues), and the wall-clock time of the run
+def run_pipeline(model_name='llama3.2', dataset_folder=transcript_maker.dataset_folder, transcripts_folder=transcript_maker.transcripts_folder,
+                 workers=4, extract_workers=1, queue_size=8, force=False, backend=None, host=player_ranker.local_host, timeout=120,
+                 retries=0, backoff=1.0, cache=player_ranker.default_cache, resume=False, stream=False,
+                 keep_alive=prompt_builder.default_keep_alive, chunk=None, sampling=None, batch_size=8, ranks_name='ranks.txt', pull=True,
+                 max_rounds=None, store_path=None):
+    start_time = time.perf_counter()
+    workers = max(1, workers)
+    own_backend = backend is None
+    if own_backend:
+        in_flight = workers * (sampling.in_flight() if sampling is not None else 1)
+        backend = backends.OllamaBackend(host=host, timeout=timeout, pool_size=in_flight)
+
+    builder, options = player_ranker.chunk_builder(chunk, model_name, backend)
+    if store_path is not None:
+        from session_store import SessionStore
+        prompt_function = player_ranker.store_prompt_maker(SessionStore(store_path), builder)
+    else:
+        prompt_function = partial(player_ranker.prompt_maker, builder=builder)
+    count_tokens = prompt_builder.local_tokenizer()
+    ranker = player_ranker.ModelRanker(model_name, backend, cache, sampling, pull, retries, backoff, stream, keep_alive, options)
+
+    # transcripts ranked by an earlier (interrupted) run of this model are not ranked again
+    journal_path = rank_journal.journal_location(transcripts_folder, ranks_name)
+    journaled = rank_journal.read_journal(journal_path, model_name) if resume else {}
+    if resume:
+        print(f"Resuming: {len(journaled)} transcripts already ranked")
+
+    file_queue = queue.Queue(maxsize=queue_size)
+    prompt_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    times = {'extract': 0.0, 'prompt': 0.0, 'rank': 0.0, 'grade': 0.0}
+    times_lock = threading.Lock()
+    errors = []
+    # set when a stage fails: the stages before it stop working, and the ones after it keep taking from their queues
+    # until the end, so no stage is ever left waiting to put into a full queue
+    stop = threading.Event()
+
+    def add_time(stage, started):
+        with times_lock:
+            times[stage] += time.perf_counter() - started
+
+    # extract: every transcript file of the dataset, in the order they are ready
+    def extract_stage():
+        try:
+            started = time.perf_counter()
+            manifest, directories, jobs = transcript_maker.plan_sessions(dataset_folder, transcripts_folder, force, max_rounds)
+            entries = manifest['sessions']
+            add_time('extract', started)
+            # transcripts that are already up to date need no work
+            building = set(jobs)
+            for key in sorted(entries, key=lambda key: entries[key]['session']):
+                if key not in building and not stop.is_set():
+                    for output in entries[key]['outputs']:
+                        file_queue.put(output)
+
+            def built(key, written):
+                transcript_maker.replace_outputs(transcripts_folder, entries[key], written)
+                for output in written:
+                    file_queue.put(output)
+
+            arguments = [(directories[key], entries[key]['session'], transcripts_folder, entries[key]['seed'], max_rounds) for key in jobs]
+            if extract_workers > 1 and len(jobs) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=extract_workers) as executor:
+                    started = time.perf_counter()
+                    futures = {executor.submit(transcript_maker.process_session, *job): key for key, job in zip(jobs, arguments)}
+                    for future in as_completed(futures):
+                        if stop.is_set():
+                            executor.shutdown(cancel_futures=True)
+                            break
+                        written = future.result()
+                        add_time('extract', started)
+                        built(futures[future], written)
+                        started = time.perf_counter()
+            else:
+                for key, job in zip(jobs, arguments):
+                    if stop.is_set():
+                        break
+                    started = time.perf_counter()
+                    written = transcript_maker.process_session(*job)
+                    add_time('extract', started)
+                    built(key, written)
+
+            # a stopped run leaves the manifest as it was, since the sessions it did not build would look up to date
+            if not stop.is_set():
+                manifest['version'] = transcript_maker.manifest_version
+                transcript_maker.write_manifest(transcripts_folder, manifest)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            file_queue.put(end_of_queue)
+
+    # prompt: (file, prompts, Players) for every transcript file
+    def prompt_stage():
+        try:
+            while True:
+                transcript_file = file_queue.get()
+                if transcript_file is end_of_queue:
+                    break
+                if stop.is_set() or transcript_file in journaled:
+                    continue
+                started = time.perf_counter()
+                try:
+                    with instrumentation.span('prompt build'):
+                        file_prompts, Players = prompt_function(os.path.join(transcripts_folder, transcript_file))
+                except Exception as e:
+                    print(f"Error processing file {transcript_file}: {e}")
+                    continue
+                finally:
+                    add_time('prompt', started)
+                file_prompts = player_ranker.prompt_list(file_prompts)
+                for prompt in file_prompts:
+                    instrumentation.observe('prompt tokens', count_tokens(prompt))
+                prompt_queue.put((transcript_file, file_prompts, Players))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            # let the extract stage finish putting its files
+            while file_queue.get() is not end_of_queue:
+                pass
+        finally:
+            # one end for each rank thread
+            for worker in range(workers):
+                prompt_queue.put(end_of_queue)
+
+    # returns (response, usage) for each (file, prompts, Players) item, or None for an item whose prompts failed
+    # the prompts not in the response cache are sent together (see player_ranker.ModelRanker.rank),
+    # and the responses to a transcript's chunks are merged into one
+    def rank_items(items):
+        found = iter(ranker.lookup([prompt for transcript_file, file_prompts, Players in items for prompt in file_prompts]))
+        responses = [[next(found) for prompt in file_prompts] for transcript_file, file_prompts, Players in items]
+        requests = [] # (item number, prompt number)
+        for item_number, (transcript_file, file_prompts, Players) in enumerate(items):
+            requests += [(item_number, number) for number, response in enumerate(responses[item_number]) if response is None]
+        results = ranker.rank([(player_ranker.part_name(items[item_number][0], number, len(items[item_number][1])),
+                                items[item_number][1][number], items[item_number][2]) for item_number, number in requests]) if requests else []
+
+        usage = [[] for item in items]
+        failed = set()
+        for (item_number, number), result in zip(requests, results):
+            if result is None:
+                failed.add(item_number)
+                continue
+            responses[item_number][number], part_usage = result
+            usage[item_number].append(part_usage)
+        return [None if item_number in failed else player_ranker.merge_parts(transcript_file, responses[item_number], usage[item_number], Players)
+                for item_number, (transcript_file, file_prompts, Players) in enumerate(items)]
+
+    # rank: (file, response, Players, usage) for every transcript the model ranked
+    # a backend that takes batches gets every waiting transcript at once, up to batch_size of them
+    # a batch that fails (the pull, or a backend error rank_transcript does not handle) stops the run,
+    # and the thread goes on taking prompts until the end of the queue so the stages before it can finish
+    batching = ranker.batching
+    def rank_stage():
+        try:
+            finished = False
+            while not finished:
+                item = prompt_queue.get()
+                if item is end_of_queue:
+                    break
+                if stop.is_set():
+                    continue
+                items = [item]
+                while batching and len(items) < batch_size:
+                    try:
+                        item = prompt_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is end_of_queue:
+                        finished = True
+                        break
+                    items.append(item)
+                started = time.perf_counter()
+                try:
+                    results = rank_items(items)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+                    continue
+                finally:
+                    add_time('rank', started)
+                for (transcript_file, file_prompts, Players), result in zip(items, results):
+                    if result is not None:
+                        result_queue.put((transcript_file, result[0], Players, result[1]))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            result_queue.put(end_of_queue)
+
+    # the stages write the transcripts and the journal into the folder, so it has to exist before any of them starts
+    os.makedirs(transcripts_folder, exist_ok=True)
+    threads = [threading.Thread(target=extract_stage, daemon=True), threading.Thread(target=prompt_stage, daemon=True)]
+    threads += [threading.Thread(target=rank_stage, daemon=True) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # grade: runs here, until every rank thread has finished
+    # each response is parsed and its percentile rank shown as it arrives, the other metrics are computed at the end
+    sessions = []
+    for transcript_file, record in journaled.items():
+        try:
+            sessions.append(rank_grader.parse_response(transcript_file, record['response'], record['players']))
+        except Exception as e:
+            print(f"Could not grade {transcript_file}: {e}")
+    running = len(threads) - 2
+    with rank_journal.open_journal(journal_path) if resume else open(journal_path, 'w') as journal:
+        while running:
+            item = result_queue.get()
+            if item is end_of_queue:
+                running -= 1
+                continue
+            transcript_file, response, Players, usage = item
+            started = time.perf_counter()
+            rank_journal.append_record(journal, model_name, transcript_file, response, Players, usage)
+            try:
+                sessions.append(rank_grader.parse_response(transcript_file, response, Players))
+                print(f"Graded {transcript_file}: mafia percentile rank {sessions[-1]['avg_mafia_rank']:.1f}")
+            except Exception as e:
+                print(f"Could not grade {transcript_file}: {e}")
+            add_time('grade', started)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    # ranks.txt in file order, as player_ranker.ollama_rank writes it
+    started = time.perf_counter()
+    records = rank_journal.read_journal(journal_path, model_name)
+    rank_journal.write_ranks(records, player_ranker.transcript_list(transcripts_folder), os.path.join(transcripts_folder, ranks_name))
+    sessions.sort(key=lambda session: (transcript_maker.transcript_session(session['file_name']), transcript_maker.transcript_round(session['file_name']),
+                                       session['names_changed']))
+    metrics = rank_grader.session_metrics(sessions)
+    metrics.insert(0, 'model', model_name)
+    summary = rank_grader.summarize(metrics)
+    add_time('grade', started)
+
+    ranker.close()
+    if own_backend:
+        backend.close()
+    times['seconds'] = time.perf_counter() - start_time
+    print(f"Pipeline complete: {len(records)} transcripts ranked in {times['seconds']:.1f}s "
+          f"(extract {times['extract']:.1f}s, prompt {times['prompt']:.1f}s, rank {times['rank']:.1f}s, grade {times['grade']:.1f}s)")
+    return metrics, summary, times
+
+
+# command line usage:
+#   python pipeline.py llama3.2 --workers 4
+#   python mafia_eval.py pipeline llama3.2 --workers 4
+command_description = "Build, rank and grade the dataset in one pipelined run"
+
+def add_arguments(parser):
+    parser.add_argument('model_name', nargs='?', default='llama3.2')
+    parser.add_argument('--dataset', default=transcript_maker.dataset_folder)
+    parser.add_argument('--transcripts', default=transcript_maker.transcripts_folder)
+    parser.add_argument('--workers', type=int, default=4, help="prompts sent to the model at once")
+    parser.add_argument('--extract-workers', type=int, default=1, help="sessions built in parallel processes")
+    parser.add_argument('--queue-size', type=int, default=8, help="transcripts each stage may run ahead of the next")
+    parser.add_argument('--force', action='store_true', help="rebuild every session, not just the changed ones")
+    parser.add_argument('--rounds', type=int, default=None, help="only build the first N rounds of each game (default: all)")
+    parser.add_argument('--host', default=player_ranker.local_host)
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait on each prompt")
+    parser.add_argument('--retries', type=int, default=0, help="times to retry a failed prompt")
+    parser.add_argument('--store', default=None, help="make the prompts from this session store (see session_store.py)")
+    player_ranker.add_ranking_arguments(parser)
+
+def run_command(args):
+    backend, cache, chunk, sampling = player_ranker.ranking_settings(args)
+    metrics, summary, times = run_pipeline(args.model_name, args.dataset, args.transcripts, workers=args.workers,
+                                           extract_workers=args.extract_workers, queue_size=args.queue_size, force=args.force, max_rounds=args.rounds,
+                                           backend=backend, host=args.host, timeout=args.timeout, retries=args.retries, cache=cache,
+                                           resume=args.resume, stream=args.stream, chunk=chunk, sampling=sampling,
+                                           store_path=args.store)
+    print(summary.pivot_table(index=['model', 'metric'], columns='condition', values='mean'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=command_description)
+    add_arguments(parser)
+    run_command(parser.parse_args())
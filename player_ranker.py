@@ -7,64 +7,400 @@
 
 ## imports ##
 import os
-import ollama
+import re
+import time
+import threading
+from statistics import mean
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import backends
+from response_cache import ResponseCache, default_cache_path
+import rank_journal
+import instrumentation
+import prompt_builder
+from rank_grader import mafia_line_pattern, names_pattern, ranking_section, response_ranking # the answer format's parser
+from prompt_builder import build_prompt
 #https://github.com/ollama/ollama-python
 #https://github.com/ollama/ollama
 
-# setup the client that will run model via Ollama
-local_host='http://localhost:11434'
-client = ollama.Client(host=local_host, timeout=120)
-print(f"running Ollama client at {local_host}...")
+# address of the Ollama server the models run on
+local_host = backends.local_host
 
 
 
 
+# Settings that ollama_rank and pipeline.run_pipeline take as a group (None for each turns it off)
+
+# Saving responses in the response cache (see response_cache.py)
+#   path: where the cache is
+#   refresh: prompt the model again even if a response is saved, and save the new one
+class CacheSettings:
+    def __init__(self, path=default_cache_path, refresh=False):
+        self.path = path
+        self.refresh = refresh
+
+# Splitting transcripts too long for the model's context window into overlapping chunks of speaker turns,
+# ranking the chunks at the same time and merging their rankings (see merge_rankings)
+#   context_tokens: the context window to fit the chunks in, read from the model if None
+class ChunkSettings:
+    def __init__(self, context_tokens=None):
+        self.context_tokens = context_tokens
+
+# Self-consistency sampling: each prompt is sent up to `samples` times, with different seeds and temperatures,
+# and the rankings are aggregated, stopping early once the aggregate settles (see rank_sampled)
+#   method: 'mean' (mean rank) or 'kemeny' (approximate Kemeny ranking) aggregation, see aggregate_ranking
+#   min_samples, step, seed: samples drawn at once first and at each step after, and the first seed
+class SampleSettings:
+    def __init__(self, samples=5, method='mean', min_samples=3, step=2, seed=0):
+        self.samples = samples
+        self.method = method
+        self.min_samples = min_samples
+        self.step = step
+        self.seed = seed
+
+    # the most samples of one prompt waiting on the server at once
+    def in_flight(self):
+        return max(1, self.min_samples, self.step)
+
+# the cache settings used unless a run is given others
+default_cache = CacheSettings()
+
+# returns (builder, options) for chunk settings (or None): the prompt builder to use and the model options to send
+# (a chunked run makes sure the server uses the window the prompts were fitted to)
+def chunk_builder(chunk, model_name, backend):
+    if chunk is None:
+        return build_prompt, None
+    context_tokens = chunk.context_tokens if chunk.context_tokens is not None else backend.context_length(model_name)
+    print(f"Fitting prompts in a context window of {context_tokens} tokens")
+    return prompt_builder.chunked_builder(context_tokens), {'num_ctx': context_tokens}
+
+# returns the prompts of a transcript as a list (a prompt function gives a string, or a list of chunk prompts)
+def prompt_list(file_prompts):
+    return [file_prompts] if isinstance(file_prompts, str) else list(file_prompts)
+
+# returns the name a prompt of a transcript is shown under: the file's, with the part number if there are several
+def part_name(transcript_file, number, count):
+    return transcript_file if count == 1 else f"{transcript_file} (part {number + 1} of {count})"
+
+# returns (response, usage) of a transcript from the responses and usage of its parts, in order:
+# a single part's own, or the chunks' rankings merged (see merge_rankings) with the usage of every part
+def merge_parts(transcript_file, responses, usages, Players):
+    if len(responses) == 1:
+        return responses[0], usages[0] if usages else None
+    return merge_rankings(transcript_file, responses, Players), {'parts': usages}
+
+# Prompts one model for ollama_rank and pipeline.run_pipeline, and may be shared by their threads:
+# looks prompts up in the response cache, pulls the model the first time a prompt is not there (only then is the
+# server needed), and sends the rest alone (streamed or sampled, if so set) or as batches
+class ModelRanker:
+    def __init__(self, model_name, backend, cache=default_cache, sampling=None, pull=True, retries=0, backoff=1.0, stream=False,
+                 keep_alive=None, options=None):
+        self.model_name = model_name
+        self.backend = backend
+        self.response_cache = ResponseCache(cache.path) if cache is not None else None
+        self.refresh = cache is not None and cache.refresh
+        self.sampling = sampling
+        self.retries = retries
+        self.backoff = backoff
+        self.stream = stream
+        self.keep_alive = keep_alive
+        self.options = options
+        # a sampled prompt is sent alone (its samples go at the same time), and so is a streamed one
+        self.batching = backend.supports_batch and not stream and sampling is None
+        self.digest = backend.model_digest(model_name)
+        self.pulled = not pull
+        self.lock = threading.Lock()
+
+    # the options a response is saved under: the ones sent with the prompt, and for a sampled ranking the
+    # settings its samples were drawn with, so it is saved apart from single responses and other samplings
+    def cache_options(self):
+        sampling = self.sampling
+        if sampling is None:
+            return self.options
+        return dict(self.options or {}, samples=sampling.samples, sample_method=sampling.method, min_samples=sampling.min_samples,
+                    sample_step=sampling.step, seed=sampling.seed, temperatures=list(default_temperatures))
+
+    # returns the saved responses to the prompts (None for each prompt without one), for the model as it is installed now
+    # the first time one is missing the model is pulled, and if that updated it the prompts are looked up again
+    def lookup(self, prompts):
+        responses = [self.cached(prompt) for prompt in prompts]
+        if None in responses and self.pull():
+            responses = [self.cached(prompt) for prompt in prompts]
+        return responses
+
+    def cached(self, prompt):
+        if self.response_cache is None or self.refresh or self.digest is None:
+            return None
+        return self.response_cache.get(self.model_name, self.digest, prompt, self.cache_options())
+
+    def save(self, prompt, response):
+        if self.response_cache is not None and self.digest is not None:
+            self.response_cache.put(self.model_name, self.digest, prompt, response, self.cache_options())
+
+    # pulls the model, once, unless the run was told not to
+    # returns True if the pull updated the model, making the responses saved for it stale
+    def pull(self):
+        with self.lock:
+            if self.pulled:
+                return False
+            # pull the model you wish to run from meta
+            print(f"Pulling model: {self.model_name}")
+            self.backend.pull(self.model_name) #ollama pull <model_name>
+            self.pulled = True
+            digest, self.digest = self.digest, self.backend.model_digest(self.model_name)
+            return self.digest != digest
+
+    # prompts the model with (name, prompt, Players) requests and saves the responses
+    # returns (response, usage) for each request, or None for a request that failed
+    def rank(self, requests):
+        sampling = self.sampling
+        if sampling is not None:
+            results = [rank_sampled(self.model_name, name, prompt, self.backend, self.retries, self.backoff, Players, self.keep_alive,
+                                    self.options, sampling.samples, sampling.min_samples, sampling.step, sampling.method, seed=sampling.seed)
+                       for name, prompt, Players in requests]
+        elif len(requests) == 1:
+            name, prompt, Players = requests[0]
+            results = [rank_transcript(self.model_name, name, prompt, self.backend, self.retries, self.backoff, Players, self.stream,
+                                       self.keep_alive, self.options)]
+        else:
+            results = rank_batch(self.model_name, [request[0] for request in requests], [request[1] for request in requests],
+                                 self.backend, self.retries, self.backoff, self.keep_alive, self.options)
+        for (name, prompt, Players), result in zip(requests, results):
+            if result is not None:
+                self.save(prompt, result[0])
+        return results
+
+    def close(self):
+        if self.response_cache is not None:
+            print(self.response_cache.stats())
+            self.response_cache.close()
+
+
 # Inputs: name of model and location of transcripts folder
 # For each transcript in the folder;
 #   Generates a prompt
 #   prompts ollama to rank perticipants in order of 'most likely to be in the deceptive role'
 #   prints the response
-# records the responses to a ranks.txt file
-def ollama_rank(model_name='llama3.2', transcripts_folder='transcripts'):
+# records each response to a journal (ranks.jsonl) as soon as it arrives
+# and writes the ranks.txt file from the journal at the end
+# Optional inputs:
+#   workers: how many prompts may be waiting on the server at once (1 = one after another)
+#   timeout: seconds to wait on a single request before it counts as failed
+#   retries, backoff: failed requests are retried, waiting backoff, 2*backoff, 4*backoff... seconds
+#   host: address of the Ollama server
+#   cache: a CacheSettings to reuse responses saved for the same model and prompt (None to not use the cache)
+#   resume: keep the journal of an earlier (interrupted) run and skip the transcripts it already has
+#   prompt_function: builds (prompt, Players) from a transcript file, prompt_maker by default
+#   ranks_name: name of the ranks file, the journal is named after it (ranks.txt -> ranks.jsonl)
+#   pull: pull the model before prompting it, if any prompt is not cached (the sweep pulls each model once itself)
+#   store_path: read the transcripts from this session store (see session_store.py) instead of the folder,
+#               which then only holds the ranks files
+#   stream: stream the responses and stop each one as soon as its ranking is complete (see ollama_stream_response)
+#   keep_alive: how long the server keeps the model loaded after each prompt, so the instructions every prompt
+#               starts with stay in its cache (see prompt_builder.py)
+#   chunk: a ChunkSettings to split transcripts too long for the model's context window
+#          (a given prompt_function does its own chunking, see prompt_builder.chunked_builder)
+#   backend: the model server to prompt (see backends.py), an Ollama server at host by default
+#            (with a connection pool as large as `workers`)
+#   batch_size: prompts sent in one call to a backend that takes batches (see backends.Backend.supports_batch)
+#   sampling: a SampleSettings to sample each prompt several times and aggregate the rankings (sampled responses are not streamed)
+# a prompt function may return a list of prompts for a transcript, whose responses are merged the same way
+# returns a summary of the run (counts, token usage and time taken)
+def ollama_rank(model_name='llama3.2', transcripts_folder='transcripts', workers=1, timeout=120, retries=0, backoff=1.0, host=local_host,
+                cache=default_cache, resume=False, prompt_function=None, ranks_name='ranks.txt', pull=True, store_path=None, stream=False,
+                keep_alive=prompt_builder.default_keep_alive, chunk=None, backend=None, batch_size=8, sampling=None):
     if not os.path.exists(transcripts_folder):
         print(f"Error: The folder '{transcripts_folder}' does not exist.")
         return
+    store = None
+    if store_path is not None:
+        from session_store import SessionStore
+        store = SessionStore(store_path)
+    start_time = time.perf_counter()
     
-    # pull the model you wish to run from meta
-    print(f"Pulling model: {model_name}")
-    client.pull(model_name) #ollama pull <model_name>
+    # a backend made for this run is closed at the end of it
+    own_backend = backend is None
+    if own_backend:
+        # every worker may have all the samples of a step waiting on the server at once (see rank_sampled),
+        # and a request waiting on a free connection counts against the timeout
+        in_flight = max(1, workers) * (sampling.in_flight() if sampling is not None else 1)
+        backend = backends.OllamaBackend(host=host, timeout=timeout, pool_size=in_flight)
 
-    #create/open ranks.txt file to record upcoming responses
-    with open(os.path.join(transcripts_folder, 'ranks.txt'), 'w') as output_file:
-        
-        # for every record in the given folder
-        for transcript_file in os.listdir(transcripts_folder):
-            
-            # Skip the output file if found
-            if transcript_file == 'ranks.txt':
-                continue
-            
-            #confirm that the file path is valid
-            file_path = os.path.join(transcripts_folder, transcript_file)
-            if os.path.isfile(file_path) and transcript_file.endswith('.txt'):
-                
-                print(f"Processing file: {transcript_file}...")
-                try:
-                    #generate prompt and Players dictionary
-                    prompt, Players = prompt_maker(file_path)
-                    print(f"Generated prompt")
-                    
-                    #pass prompt and record response
-                    response = ollama_response(model_name, prompt)
-                    print(f"Model response: \n{response}\n")
-                    
-                    # record the response to the ranks file with player roles added
-                    output_file.write(f"File: {transcript_file}\n{response}\n{Players}\n\n\n")
-                    
-                except Exception as e:
-                    print(f"Error processing file {transcript_file}: {e}")
+    builder, options = chunk_builder(chunk, model_name, backend)
+    if prompt_function is None:
+        prompt_function = partial(prompt_maker, builder=builder) if store is None else store_prompt_maker(store, builder)
+    ranker = ModelRanker(model_name, backend, cache, sampling, pull, retries, backoff, stream, keep_alive, options)
+
+    # sorted so ranks.txt is always written in the same order
+    transcript_files = transcript_list(transcripts_folder) if store is None else store.transcript_names()
+
+    # transcripts finished by an earlier run of this model
+    journal_path = rank_journal.journal_location(transcripts_folder, ranks_name)
+    if resume:
+        finished = rank_journal.read_journal(journal_path, model_name)
+        print(f"Resuming: {len(finished)} transcripts already ranked")
+    else:
+        rank_journal.clear_journal(journal_path)
+
+    #generate prompt and Players dictionary for every transcript not yet ranked
+    prompts = {}
+    for transcript_file in transcript_files:
+        if resume and transcript_file in finished:
+            continue
+        print(f"Processing file: {transcript_file}...")
+        try:
+            with instrumentation.span('prompt build'):
+                file_prompts, Players = prompt_function(os.path.join(transcripts_folder, transcript_file))
+            prompts[transcript_file] = (prompt_list(file_prompts), Players)
+        except Exception as e:
+            print(f"Error processing file {transcript_file}: {e}")
+
+    # every prompt is sent on its own, keyed by (file, part), and a file with one prompt has a single part 0
+    parts = {(transcript_file, number): prompt for transcript_file, (file_prompts, Players) in prompts.items()
+             for number, prompt in enumerate(file_prompts)}
+    part_counts = {transcript_file: len(file_prompts) for transcript_file, (file_prompts, Players) in prompts.items()}
+    if len(parts) > len(prompts):
+        print(f"{sum(1 for count in part_counts.values() if count > 1)} transcripts split into chunks, {len(parts)} prompts in total")
+
+    # the responses saved for the model (the model is pulled only if something is left to ask)
+    found = ranker.lookup(list(parts.values()))
+    responses = {part: response for part, response in zip(parts, found) if response is not None}
+
+    # prompt the model for every prompt still missing, with at most `workers` requests running at once
+    # (the chunks of a transcript are sent one after another, so they run at the same time)
+    missing = [part for part in parts if part not in responses]
+    cached = len(responses)
+    usage = [] # token counts and timings of each response (see ollama_response)
+    # prompt sizes counted locally, and the part of each the server cannot take from its cache of the prompt before
+    local_tokens = prompt_builder.prompt_tokens([parts[part] for part in missing])
+    for tokens in local_tokens['tokens']:
+        instrumentation.observe('prompt tokens', tokens)
+    local_tokens = dict(zip(missing, zip(local_tokens['tokens'], local_tokens['prefill'])))
+    instrumentation.count('cached responses', cached)
+    # a backend that takes batches gets up to batch_size prompts per call, any other gets one prompt per call
+    if not ranker.batching:
+        batch_size = 1
+    batches = [missing[start:start + batch_size] for start in range(0, len(missing), max(1, batch_size))]
+    def rank_parts(batch):
+        return ranker.rank([(part_name(part[0], part[1], part_counts[part[0]]), parts[part], prompts[part[0]][1]) for part in batch])
+
+    # a transcript is journaled once the responses to all its parts are in
+    part_responses = {transcript_file: {} for transcript_file in part_counts}
+    part_usage = {transcript_file: [] for transcript_file in part_counts}
+    def finish_part(journal, part, response, response_usage=None):
+        transcript_file, number = part
+        part_responses[transcript_file][number] = response
+        if response_usage is not None:
+            part_usage[transcript_file].append(response_usage)
+        if len(part_responses[transcript_file]) < part_counts[transcript_file]:
+            return
+        Players = prompts[transcript_file][1]
+        response, file_usage = merge_parts(transcript_file, [part_responses[transcript_file][n] for n in range(part_counts[transcript_file])],
+                                           part_usage[transcript_file], Players)
+        rank_journal.append_record(journal, model_name, transcript_file, response, Players, file_usage)
+
+    with rank_journal.open_journal(journal_path) as journal:
+        # cached responses are journaled straight away
+        for part, response in responses.items():
+            finish_part(journal, part, response)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            futures = {executor.submit(rank_parts, batch): batch for batch in batches}
+            # record each response as soon as it arrives, in whatever order they finish
+            for future in as_completed(futures):
+                for part, result in zip(futures[future], future.result()):
+                    # failed prompts return None, and their transcripts are left out
+                    if result is None:
+                        continue
+                    response, response_usage = result
+                    response_usage['local_prompt_tokens'], response_usage['local_prefill_tokens'] = local_tokens[part]
+                    usage.append(response_usage)
+                    finish_part(journal, part, response, response_usage)
+        except KeyboardInterrupt:
+            # drop the queued prompts, everything finished so far is in the journal
+            executor.shutdown(wait=False, cancel_futures=True)
+            print(f"Interrupted! Rerun with resume=True to rank the remaining transcripts.")
+            raise
+        executor.shutdown()
+
+    #create ranks.txt from the journal, with player roles added
+    records = rank_journal.read_journal(journal_path, model_name)
+    rank_journal.write_ranks(records, transcript_files, os.path.join(transcripts_folder, ranks_name))
+
+    ranker.close()
+    if own_backend:
+        backend.close()
     print("Complete!")
 
+    first_token_times = [entry['first_token_seconds'] for entry in usage if entry['first_token_seconds'] is not None]
+    return {
+        'model': model_name,
+        'folder': transcripts_folder,
+        'transcripts': len(transcript_files),
+        'ranked': len(records),
+        'prompted': len(usage),
+        'samples': sum(entry.get('samples', 1) for entry in usage),
+        'sample_agreement': mean(entry['agreement'] for entry in usage) if sampling is not None and usage else None,
+        'cached': cached,
+        'chunked': sum(1 for count in part_counts.values() if count > 1),
+        'prompt_tokens': sum(entry['prompt_eval_count'] for entry in usage),
+        'local_prompt_tokens': sum(entry['local_prompt_tokens'] for entry in usage),
+        'local_prefill_tokens': sum(entry['local_prefill_tokens'] for entry in usage),
+        'eval_tokens': sum(entry['eval_count'] for entry in usage),
+        'eval_seconds': sum(entry['eval_duration'] for entry in usage) / 1e9,
+        'first_token_seconds': mean(first_token_times) if first_token_times else None,
+        'stopped_early': sum(1 for entry in usage if entry['stopped_early']),
+        'seconds': time.perf_counter() - start_time,
+    }
+
+# returns a sorted list of the transcript files in the given folder (ranks files are skipped)
+def transcript_list(transcripts_folder):
+    transcript_files = []
+    for transcript_file in sorted(os.listdir(transcripts_folder)):
+        
+        # Skip the output files if found (ranks.txt, or the ranks_<model>_<variant>.txt files of a sweep)
+        if transcript_file.startswith('ranks'):
+            continue
+        
+        #confirm that the file path is valid
+        file_path = os.path.join(transcripts_folder, transcript_file)
+        if os.path.isfile(file_path) and transcript_file.endswith('.txt'):
+            transcript_files.append(transcript_file)
+    return transcript_files
+
+# prompts the model with a single transcript's prompt
+# returns (response, usage) (see ollama_response), or None if the transcript could not be ranked
+# with stream=True the response is streamed and stopped once every one of the players is ranked
+def rank_transcript(model_name, transcript_file, prompt, backend, retries=0, backoff=1.0, players=None, stream=False, keep_alive=None, options=None):
+    usage = []
+    try:
+        #pass prompt and record response
+        if stream:
+            response = ollama_stream_response(model_name, prompt, players, backend, retries, backoff, usage, keep_alive, options)
+        else:
+            response = ollama_response(model_name, prompt, backend, retries, backoff, usage, keep_alive, options)
+        print(f"Model response for {transcript_file}: \n{response}\n")
+        return response, usage[-1]
+        
+    except Exception as e:
+        print(f"Error processing file {transcript_file}: {e}")
+        return None
+
+# prompts the model with a batch of prompts in one call (see backends.Backend.generate_batch)
+# returns a list with (response, usage) for each prompt, or None for every prompt if the batch failed
+def rank_batch(model_name, transcript_files, prompts, backend, retries=0, backoff=1.0, keep_alive=None, options=None):
+    usage = []
+    try:
+        responses = ollama_batch_response(model_name, prompts, backend, retries, backoff, usage, keep_alive, options)
+        for transcript_file, response in zip(transcript_files, responses):
+            print(f"Model response for {transcript_file}: \n{response}\n")
+        return list(zip(responses, usage))
+
+    except Exception as e:
+        print(f"Error processing files {', '.join(transcript_files)}: {e}")
+        return [None] * len(prompts)
+
 # returns a dictionary of players and their roles from the given string
 def parse_players(players_string):
     #print(f"Parsing last line:{players_string}")
@@ -88,7 +424,8 @@ def parse_players(players_string):
 #print(parse_players("Players: ['Ryan Hodges:mafia', 'Mary Trujillo:town', 'Christopher Smith:town', 'Diana Pennington:town', 'Christina Rollins:town', 'Troy Thomas:town', 'Natalie Morris:mafia']"))
 
 # Returns (as string) a prompt for the model based on info from the given file
-def prompt_maker(file_location):
+# the prompt is built by prompt_builder.build_prompt unless another builder (file name, transcript, players) is given
+def prompt_maker(file_location, builder=build_prompt):
 
     # read data from file and save as local variable
     with open(file_location, 'r') as file:
@@ -116,32 +453,19 @@ def prompt_maker(file_location):
     transcript = ''.join(lines[:-1])
     print(f"Transcript extracted")
 
-    # Define the main question and output format
-    main_question = 'Rank the players in order of most likely to be in the deceptive role.'
-    output_format = '''
-    Please only answer in the following format:
-    Session: session_number
-    Rank:
-    <Player Name>
-    <Player Name>
-    ...
-    <Player Name>
-    
-    Actualy likely to be Mafia: <Player Names or 'none'>
-    '''
-
-    # Create and return the prompt
-    prompt = f'''
-    The game of Mafia is a social deduction game where players try to identify the members of the mafia among them. The names given are aliases and not the real player names.
-    The following is a transcript from the first round of a particular session of Mafia.
-    File: {os.path.basename(file_location)}
-    Transcript:
-    {transcript}
-    The players are: {', '.join(players_list)}
-    {main_question}
-    {output_format}
-    '''
-    return prompt, players
+    return builder(os.path.basename(file_location), transcript, players), players
+
+# returns a prompt function (like prompt_maker) that reads the transcripts from a session store
+# instead of the transcript files (see session_store.py)
+def store_prompt_maker(store, builder=build_prompt):
+    from session_store import parse_transcript_name
+
+    def make_prompt(file_location):
+        file_name = os.path.basename(file_location)
+        session, anonymized, round_number = parse_transcript_name(file_name)
+        players = store.players(session, anonymized, round_number)
+        return builder(file_name, store.transcript(session, anonymized, round_number), players), players
+    return make_prompt
 
 # generate a sample prompt for demonstration purposes
 def sample_prompt(transcripts_folder='transcripts', transcript_file='session_1.txt'):
@@ -159,16 +483,269 @@ def sample_prompt(transcripts_folder='transcripts', transcript_file='session_1.t
 
 # given a model name and a prompt 
 # prompts the model and returns the response given
-def ollama_response(model_name, prompt):
+# a failed request is tried again up to `retries` times, waiting longer after each failure
+# if a usage list is given, a dictionary of the response's token counts and timings is appended to it:
+#   prompt_eval_count, eval_count: prompt and response tokens
+#   eval_duration, total_duration: nanoseconds spent generating and in total
+#   tokens_per_second: response tokens per second of generation
+#   first_token_seconds: time until the first token arrived (streamed responses only, otherwise None)
+#   stopped_early: True if the response was cut off once its ranking was complete
+# keep_alive is passed on to the server (None leaves the model loaded for the server's default time),
+# as are the model options (such as num_ctx)
+# the backend is an Ollama server at local_host unless another one is given (see backends.py)
+def ollama_response(model_name, prompt, backend=None, retries=0, backoff=1.0, usage=None, keep_alive=None, options=None):
+    if backend is None:
+        backend = backends.default_backend()
     
     # run the model, generate and record the response
     print(f"Prompting the model...")
-    response = client.generate(model_name, prompt)
+    with instrumentation.span('model latency'):
+        response = with_retries(lambda: backend.generate(model_name, prompt, keep_alive, options), retries, backoff)
+    instrumentation.count('prompts sent')
     print(f"Model response complete.")
+
+    if usage is not None:
+        usage.append(response_usage(response))
     
     #return the model's response
     return response['response']
 
+# like ollama_response, for a list of prompts sent in one call, returns the responses in order
+def ollama_batch_response(model_name, prompts, backend=None, retries=0, backoff=1.0, usage=None, keep_alive=None, options=None):
+    if backend is None:
+        backend = backends.default_backend()
+
+    print(f"Prompting the model with {len(prompts)} prompts...")
+    with instrumentation.span('model latency (batch)'):
+        responses = with_retries(lambda: backend.generate_batch(model_name, prompts, keep_alive, options), retries, backoff)
+    instrumentation.count('prompts sent', len(prompts))
+    print(f"Model responses complete.")
+
+    if usage is not None:
+        usage.extend(response_usage(response) for response in responses)
+    return [response['response'] for response in responses]
+
+# calls request() and returns what it returns, trying again up to `retries` times if it fails,
+# waiting backoff, 2*backoff, 4*backoff... seconds before each new try
+def with_retries(request, retries=0, backoff=1.0):
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Request failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+# returns the usage entry (see ollama_response) of a finished response
+def response_usage(response):
+    entry = {key: response.get(key) or 0 for key in ('prompt_eval_count', 'eval_count', 'eval_duration', 'total_duration')}
+    entry['tokens_per_second'] = entry['eval_count'] / entry['eval_duration'] * 1e9 if entry['eval_duration'] else None
+    entry['first_token_seconds'] = None
+    entry['stopped_early'] = False
+    return entry
+
+# returns where the ranking of a (partial) response ends, once it has ranked every player
+# and finished its 'Actualy likely to be Mafia' line, otherwise None (see rank_grader.ranking_section)
+def ranking_end(text, players):
+    marker = mafia_line_pattern.search(text)
+    if marker is None:
+        return None
+    # the mafia line is only finished once a new line follows it
+    end = text.find('\n', marker.end())
+    if end == -1:
+        return None
+    ranking, mafia_line = ranking_section(text)
+    if set(names_pattern(tuple(players)).findall(ranking)) >= set(players):
+        return end
+    return None
+
+# merges the responses to the chunks of one transcript into a single response in the same format
+# players are ranked by their Borda count (first of n players gets n - 1 points, last gets 0) over all the chunks,
+# ties keep the players' original order, and a player is likely Mafia if at least half of the chunks say so
+def merge_rankings(transcript_file, responses, players):
+    points = dict.fromkeys(players, 0)
+    votes = dict.fromkeys(players, 0)
+    for response in responses:
+        order, mafia = response_ranking(response, players)
+        for position, name in enumerate(order):
+            points[name] += len(order) - 1 - position
+        for name in mafia:
+            votes[name] += 1
+    ranked = sorted(players, key=lambda name: -points[name])
+    mafia = [name for name in ranked if votes[name] * 2 >= len(responses)]
+    return format_ranking(transcript_file, ranked, mafia)
+
+# returns a response in the answer format asked for by build_prompt, for a ranking made here (not by the model)
+def format_ranking(transcript_file, ranked, mafia):
+    session = re.search(r'\d+', transcript_file)
+    session = session.group(0) if session else transcript_file
+    return f"Session: {session}\nRank:\n" + "\n".join(ranked) + f"\n\nActualy likely to be Mafia: {', '.join(mafia) or 'none'}"
+
+# the temperatures the samples of a transcript cycle through (see rank_sampled)
+default_temperatures = (0.6, 0.8, 1.0)
+# ways to aggregate the rankings of several samples (see aggregate_ranking)
+sample_methods = ('mean', 'kemeny')
+
+# returns a (samples x players) array of the position (0 = most likely Mafia) each sample ranks each player at,
+# with the players in the order of the players dictionary
+def rank_positions(responses, players):
+    import numpy as np
+    index = {name: column for column, name in enumerate(players)}
+    positions = np.empty((len(responses), len(players)))
+    for row, response in enumerate(responses):
+        order, mafia = response_ranking(response, players)
+        positions[row, [index[name] for name in order]] = np.arange(len(order))
+    return positions
+
+# returns the aggregate order (column numbers of rank_positions, most likely Mafia first) of the samples' positions
+#   mean: by mean position (ties keep the players' order)
+#   kemeny: an approximation of the Kemeny ranking (the order that disagrees with the fewest pairwise preferences
+#           of the samples), starting from the mean order and swapping neighbours while a swap agrees with more samples
+#           (a local Kemeny optimum, as in Dwork et al.'s "local Kemenization")
+def aggregate_ranking(positions, method='mean'):
+    import numpy as np
+    order = np.argsort(positions.mean(axis=0), kind='stable')
+    if method == 'mean':
+        return order
+    if method != 'kemeny':
+        raise ValueError(f"Unknown aggregation method '{method}', expected one of {list(sample_methods)}")
+    # above[i, j]: the share of samples that rank player i above player j
+    above = (positions[:, :, None] < positions[:, None, :]).mean(axis=0)
+    order = order.tolist()
+    swapped = True
+    while swapped:
+        swapped = False
+        for position in range(len(order) - 1):
+            first, second = order[position], order[position + 1]
+            if above[second, first] > above[first, second]:
+                order[position], order[position + 1] = second, first
+                swapped = True
+    return np.array(order, dtype=int)
+
+# returns the share of player pairs each sample orders the same way as the aggregate order (1 = full agreement)
+def sample_agreement(positions, order):
+    import numpy as np
+    aggregate = np.empty(len(order))
+    aggregate[order] = np.arange(len(order))
+    pairs = np.triu(np.ones((len(order), len(order)), dtype=bool), k=1)
+    if not pairs.any():
+        return np.ones(len(positions))
+    agree = np.sign(positions[:, :, None] - positions[:, None, :]) == np.sign(aggregate[:, None] - aggregate[None, :])
+    return agree[:, pairs].mean(axis=1)
+
+# prompts the model with one prompt several times (self-consistency sampling) and aggregates the rankings it gives
+# Samples are sent min_samples at once and then sample_step at once, each with its own seed (seed, seed + 1, ...)
+# and a temperature from temperatures (in turn). Once the aggregate ranking (see aggregate_ranking) is the same
+# after a step as before it, or `samples` have been drawn, sampling stops
+# a player is likely Mafia if at least half of the samples say so
+# returns (response, usage) like rank_transcript, where usage adds up the samples' usage and has
+#   samples: how many were drawn, agreement: the mean share of player pairs the samples order like the aggregate
+# or None if the transcript could not be ranked
+def rank_sampled(model_name, transcript_file, prompt, backend, retries=0, backoff=1.0, players=None, keep_alive=None, options=None,
+                 samples=5, min_samples=3, sample_step=2, method='mean', temperatures=default_temperatures, seed=0):
+    import numpy as np
+    responses = []
+    usage = []
+    order = None
+    def draw(number):
+        sample_options = dict(options or {}, seed=seed + number, temperature=temperatures[number % len(temperatures)])
+        return ollama_response(model_name, prompt, backend, retries, backoff, usage, keep_alive, sample_options)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min_samples, sample_step)) as executor:
+            while len(responses) < samples:
+                step = min(min_samples if not responses else sample_step, samples - len(responses))
+                responses += executor.map(draw, range(len(responses), len(responses) + max(1, step)))
+                positions = rank_positions(responses, players)
+                previous, order = order, aggregate_ranking(positions, method)
+                if previous is not None and np.array_equal(previous, order):
+                    break
+    except Exception as e:
+        print(f"Error processing file {transcript_file}: {type(e).__name__}: {e}")
+        return None
+
+    names = list(players)
+    ranked = [names[column] for column in order]
+    votes = dict.fromkeys(names, 0)
+    for response in responses:
+        for name in response_ranking(response, players)[1]:
+            votes[name] += 1
+    response = format_ranking(transcript_file, ranked, [name for name in ranked if votes[name] * 2 >= len(responses)])
+    entry = {key: sum(sample[key] for sample in usage) for key in ('prompt_eval_count', 'eval_count', 'eval_duration', 'total_duration')}
+    entry['tokens_per_second'] = entry['eval_count'] / entry['eval_duration'] * 1e9 if entry['eval_duration'] else None
+    entry['first_token_seconds'] = None
+    entry['stopped_early'] = False
+    entry['samples'] = len(responses)
+    entry['agreement'] = float(sample_agreement(positions, order).mean())
+    instrumentation.observe('samples per transcript', len(responses))
+    print(f"Model response for {transcript_file} ({len(responses)} samples, {method} rank): \n{response}\n")
+    return response, entry
+
+# like ollama_response, but streams the response and parses it as it arrives
+# the generation is cancelled (by closing the stream) as soon as the ranking is complete (see ranking_end),
+# so the server spends no time on whatever the model would have written after its answer, which is left out
+def ollama_stream_response(model_name, prompt, players, backend=None, retries=0, backoff=1.0, usage=None, keep_alive=None, options=None):
+    if backend is None:
+        backend = backends.default_backend()
+
+    print(f"Prompting the model (streaming)...")
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        first_token = None
+        pieces = []
+        final = None
+        end = None
+        try:
+            stream = backend.stream(model_name, prompt, keep_alive, options)
+            try:
+                for chunk in stream:
+                    if chunk['response']:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        pieces.append(chunk['response'])
+                        # the ranking can only become complete at the end of a line
+                        if '\n' in chunk['response']:
+                            end = ranking_end(''.join(pieces), players)
+                            if end is not None:
+                                break
+                    if chunk.get('done'):
+                        final = chunk
+            finally:
+                stream.close() # closing the stream cancels the generation on the server
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Request failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+    finish = time.perf_counter()
+    stopped_early = end is not None
+    instrumentation.count('prompts sent')
+    instrumentation.observe('streamed response seconds', finish - start)
+    if first_token is not None:
+        instrumentation.observe('first token seconds', first_token - start)
+    print(f"Model response complete{' (stopped early)' if stopped_early else ''}.")
+
+    if usage is not None:
+        if final is not None:
+            entry = {key: final.get(key) or 0 for key in ('prompt_eval_count', 'eval_count', 'eval_duration', 'total_duration')}
+        else:
+            # a cancelled generation never reports its counts, so count the streamed chunks (one token each)
+            entry = {
+                'prompt_eval_count': 0,
+                'eval_count': len(pieces),
+                'eval_duration': int((finish - first_token) * 1e9) if first_token is not None else 0,
+                'total_duration': int((finish - start) * 1e9),
+            }
+        entry['tokens_per_second'] = entry['eval_count'] / entry['eval_duration'] * 1e9 if entry['eval_duration'] else None
+        entry['first_token_seconds'] = first_token - start if first_token is not None else None
+        entry['stopped_early'] = stopped_early
+        usage.append(entry)
+
+    return ''.join(pieces)[:end]
+
 # sample usage:
 # ollama_response('llama3.2','What is a double rainbow? Answer in one sentance, please.')
 
@@ -181,4 +758,66 @@ def ollama_response(model_name, prompt):
 #ollama_rank("qwq", "transcripts_b")
 #ollama_rank("dolphin-llama3", "transcripts_c")
 #ollama_rank("llama3.2", "transcripts_z")
-#ollama_rank("llama3.2", "transcripts_new")
\ No newline at end of file
+#ollama_rank("llama3.2", "transcripts_new")
+
+# several prompts at once (the server must allow parallel requests, see OLLAMA_NUM_PARALLEL)
+#ollama_rank("llama3.2", "transcripts_new", workers=4, retries=2)
+
+# ask the model again instead of reusing saved responses
+#ollama_rank("llama3.2", "transcripts_new", cache=CacheSettings(refresh=True))
+
+# continue a run that was interrupted
+#ollama_rank("llama3.2", "transcripts_new", resume=True)
+
+
+# command line usage:
+#   python player_ranker.py llama3.2 transcripts_new --workers 4 --no-cache
+#   python mafia_eval.py rank llama3.2 transcripts_new --workers 4 --no-cache
+command_description = "Rank the players in each transcript with an Ollama model"
+
+def add_arguments(parser):
+    parser.add_argument('model_name', nargs='?', default='llama3.2')
+    parser.add_argument('transcripts_folder', nargs='?', default='transcripts')
+    parser.add_argument('--workers', type=int, default=1, help="prompts sent to the server at once")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait on each prompt")
+    parser.add_argument('--retries', type=int, default=0, help="times to retry a failed prompt")
+    parser.add_argument('--host', default=local_host)
+    parser.add_argument('--store', default=None, help="read the transcripts from this session store")
+    parser.add_argument('--keep-alive', default=prompt_builder.default_keep_alive, help="how long the server keeps the model loaded between prompts")
+    add_ranking_arguments(parser)
+
+# the options of ranking shared with the pipeline's command line (see ranking_settings)
+def add_ranking_arguments(parser):
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="do not read or save cached responses")
+    parser.add_argument('--refresh', action='store_true', help="prompt the model again and replace cached responses")
+    parser.add_argument('--cache-path', default=default_cache_path)
+    parser.add_argument('--resume', action='store_true', help="skip the transcripts already in the folder's ranks.jsonl journal")
+    parser.add_argument('--stream', action='store_true', help="stream responses and stop each once its ranking is complete")
+    parser.add_argument('--chunk', action='store_true', help="split transcripts too long for the context window and merge the chunks' rankings")
+    parser.add_argument('--context-tokens', type=int, default=None, help="context window to fit the chunks in (read from the model by default)")
+    parser.add_argument('--backend', default='ollama', choices=list(backends.backend_types), help="model server to prompt ('fake' answers in process)")
+    parser.add_argument('--samples', type=int, default=1, help="most samples to draw per prompt and aggregate (self-consistency)")
+    parser.add_argument('--sample-method', default='mean', choices=list(sample_methods), help="how the samples' rankings are aggregated")
+    parser.add_argument('--min-samples', type=int, default=3, help="samples drawn at once before checking whether the ranking has settled")
+    parser.add_argument('--sample-step', type=int, default=2, help="samples drawn at once at each step after the first")
+    parser.add_argument('--sample-seed', type=int, default=0, help="seed of the first sample (the others count up from it)")
+
+# returns (backend, cache, chunk, sampling) from the options of add_ranking_arguments (None for the Ollama backend made by the run)
+def ranking_settings(args):
+    backend = None if args.backend == 'ollama' else backends.make_backend(args.backend)
+    cache = CacheSettings(args.cache_path, args.refresh) if args.cache else None
+    chunk = ChunkSettings(args.context_tokens) if args.chunk else None
+    sampling = SampleSettings(args.samples, args.sample_method, args.min_samples, args.sample_step, args.sample_seed) if args.samples > 1 else None
+    return backend, cache, chunk, sampling
+
+def run_command(args):
+    backend, cache, chunk, sampling = ranking_settings(args)
+    ollama_rank(args.model_name, args.transcripts_folder, workers=args.workers, timeout=args.timeout, retries=args.retries, host=args.host,
+                cache=cache, resume=args.resume, store_path=args.store, stream=args.stream, keep_alive=args.keep_alive, chunk=chunk,
+                backend=backend, sampling=sampling)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=command_description)
+    add_arguments(parser)
+    run_command(parser.parse_args())
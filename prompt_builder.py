@@ -0,0 +1,198 @@
+
+# Builds the ranking prompts so that every prompt starts with the same instructions
+# The fixed part (rules, question and answer format) comes first and the transcript last,
+# so a server that keeps the model loaded (keep_alive) reuses its cache of the shared prefix
+# and only has to read the transcript of each new prompt
+# Transcripts too long for the model's context window can be split into overlapping chunks of speaker turns,
+# one prompt per chunk (see chunked_builder)
+
+# usage: python prompt_builder.py transcripts_new
+
+## imports ##
+import os
+import re
+import argparse
+
+# how long the server should keep the model (and its prompt cache) loaded between prompts
+default_keep_alive = '30m'
+
+# Ollama's context window (num_ctx) in tokens, for models that do not set their own
+default_context_tokens = 2048
+# tokens of the context window kept free for the model's answer
+answer_tokens = 512
+
+# the instructions every prompt starts with
+shared_prefix = """The game of Mafia is a social deduction game where players try to identify the members of the mafia among them. The names given are aliases and not the real player names.
+Below is a transcript from one round (a day) of a particular session of Mafia, followed by its players.
+Rank the players in order of most likely to be in the deceptive role.
+Please only answer in the following format:
+Session: session_number
+Rank:
+<Player Name>
+<Player Name>
+...
+<Player Name>
+
+Actualy likely to be Mafia: <Player Names or 'none'>
+
+"""
+
+
+# strips the white space a transcript does not need: the ends of lines, runs of spaces and empty lines
+def compact_whitespace(text):
+    lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+# returns the prompt for one transcript: the shared prefix followed by the transcript and its players
+# part is (chunk number, number of chunks) when the transcript is one chunk of a longer one
+def build_prompt(file_name, transcript, players, part=None):
+    heading = "Transcript:" if part is None else f"Transcript (part {part[0]} of {part[1]}):"
+    return (shared_prefix
+            + f"File: {file_name}\n"
+            + f"{heading}\n{compact_whitespace(transcript)}\n"
+            + f"The players are: {', '.join(players)}\n")
+
+# splits a transcript into chunks of whole speaker turns (lines), each at most max_tokens long
+# each chunk starts with up to overlap_tokens of the turns that ended the chunk before it,
+# so a conversation cut at a chunk boundary is still read together in one of the chunks
+# a single turn longer than max_tokens becomes a chunk of its own
+def split_turns(transcript, max_tokens, overlap_tokens=0, count_tokens=None):
+    if count_tokens is None:
+        count_tokens = local_tokenizer()
+    turns = compact_whitespace(transcript).split('\n')
+    sizes = [count_tokens(turn) + 1 for turn in turns] # + 1 for the line break
+    chunks = []
+    start = 0
+    while start < len(turns):
+        end = start + 1
+        total = sizes[start]
+        while end < len(turns) and total + sizes[end] <= max_tokens:
+            total += sizes[end]
+            end += 1
+        chunks.append('\n'.join(turns[start:end]))
+        if end == len(turns):
+            break
+        # step back over the overlapping turns, but always move forward by at least one
+        next_start = end
+        overlap = 0
+        while next_start - 1 > start and overlap + sizes[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap += sizes[next_start]
+        start = next_start
+    return chunks
+
+# returns a builder (like build_prompt) that returns a list of prompts, each fitting in a context window of context_tokens
+# with answer_tokens to spare: one prompt if the transcript fits, otherwise one per chunk of the transcript (see split_turns),
+# overlapping by the given fraction of a chunk
+def chunked_builder(context_tokens=default_context_tokens, overlap=0.1, count_tokens=None):
+    if count_tokens is None:
+        count_tokens = local_tokenizer()
+    budget = context_tokens - answer_tokens
+
+    def build_chunks(file_name, transcript, players):
+        prompt = build_prompt(file_name, transcript, players)
+        if count_tokens(prompt) <= budget:
+            return [prompt]
+        # what is left of the budget for the transcript, after the rest of a chunk's prompt
+        transcript_budget = budget - count_tokens(build_prompt(file_name, '', players, part=(99, 99)))
+        if transcript_budget <= 0:
+            raise ValueError(f"A context window of {context_tokens} tokens is too small for the prompt of {file_name}")
+        chunks = split_turns(transcript, transcript_budget, int(transcript_budget * overlap), count_tokens)
+        return [build_prompt(file_name, chunk, players, part=(number, len(chunks))) for number, chunk in enumerate(chunks, 1)]
+    return build_chunks
+
+# the prompt as it was written before the shared prefix, kept to compare against (see prompt_report)
+def verbose_prompt(file_name, transcript, players):
+    players_list = list( players.keys() )
+
+    # Define the main question and output format
+    main_question = 'Rank the players in order of most likely to be in the deceptive role.'
+    output_format = '''
+    Please only answer in the following format:
+    Session: session_number
+    Rank:
+    <Player Name>
+    <Player Name>
+    ...
+    <Player Name>
+
+    Actualy likely to be Mafia: <Player Names or 'none'>
+    '''
+
+    # Create and return the prompt
+    prompt = f'''
+    The game of Mafia is a social deduction game where players try to identify the members of the mafia among them. The names given are aliases and not the real player names.
+    The following is a transcript from the first round of a particular session of Mafia.
+    File: {file_name}
+    Transcript:
+    {transcript}
+    The players are: {', '.join(players_list)}
+    {main_question}
+    {output_format}
+    '''
+    return prompt
+
+# returns a function that counts the tokens of a text
+# tiktoken's cl100k_base encoding is used if it is installed (pip install tiktoken), it is close to llama's tokenizer,
+# otherwise the tokens are estimated as words, punctuation marks and line breaks (with the indentation after them)
+def local_tokenizer():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        word_pattern = re.compile(r'\w+|[^\w\s]|\s*\n\s*|\s{2,}')
+        return lambda text: len(word_pattern.findall(text))
+
+# returns the length of the start two texts share
+def common_prefix_length(first, second):
+    length = min(len(first), len(second))
+    for position in range(length):
+        if first[position] != second[position]:
+            return position
+    return length
+
+# returns the token counts of a list of prompts (in the order they are sent):
+#   tokens: tokens in each prompt
+#   prefill: tokens of each prompt the server has to read, when it reuses the start shared with the prompt before it
+def prompt_tokens(prompts, count_tokens=None):
+    if count_tokens is None:
+        count_tokens = local_tokenizer()
+    tokens = []
+    prefill = []
+    previous = ''
+    for prompt in prompts:
+        shared = common_prefix_length(previous, prompt)
+        tokens.append(count_tokens(prompt))
+        prefill.append(tokens[-1] - count_tokens(prompt[:shared]))
+        previous = prompt
+    return {'tokens': tokens, 'prefill': prefill}
+
+# compares the token counts of the verbose and the shared prefix prompts over a transcripts folder
+def prompt_report(transcripts_folder='transcripts_new'):
+    import player_ranker
+
+    count_tokens = local_tokenizer()
+    files = player_ranker.transcript_list(transcripts_folder)
+    prompts = {'verbose': [], 'shared prefix': []}
+    for transcript_file in files:
+        file_location = os.path.join(transcripts_folder, transcript_file)
+        prompts['verbose'].append(player_ranker.prompt_maker(file_location, verbose_prompt)[0])
+        prompts['shared prefix'].append(player_ranker.prompt_maker(file_location, build_prompt)[0])
+
+    print(f"{len(files)} prompts, shared prefix of {count_tokens(shared_prefix)} tokens")
+    print(f"{'prompt':<16}{'tokens':>10}{'prefill':>10}{'tokens/prompt':>15}{'prefill/prompt':>16}")
+    report = {}
+    for name, texts in prompts.items():
+        counts = prompt_tokens(texts, count_tokens)
+        report[name] = counts
+        total, prefill = sum(counts['tokens']), sum(counts['prefill'])
+        print(f"{name:<16}{total:>10}{prefill:>10}{total / len(texts):>15.1f}{prefill / len(texts):>16.1f}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the token counts of the verbose and shared prefix prompts")
+    parser.add_argument('transcripts_folder', nargs='?', default='transcripts_new')
+    args = parser.parse_args()
+    prompt_report(args.transcripts_folder)
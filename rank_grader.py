@@ -2,8 +2,11 @@
 
 import re # regular expressions library
 import os # for file handling
-import pandas as pd # for dataset handling
-from pprint import pprint # Helps debug dictionaries by displaying them nicely
+import warnings # to quiet numpy about empty metrics
+from functools import lru_cache # remembers compiled name patterns
+import instrumentation # times parsing and grading
+from transcript_maker import transcript_session, transcript_round # the session and round a transcript is of
+# numpy, pandas and pprint are imported by the functions that use them, so importing this module is quick
 transcripts_folder = 'transcripts_new'
 
 # returns a players dictionary made from the given players string
@@ -43,111 +46,340 @@ def average_percentile_rank(mafia_list, players):
     # Return the average percentile rank of the mafia members
     return average_mafia_percentile
 
-# given file path, return dictionary with file info
-def read_ranks_file(file_path):
+# patterns used on every block, compiled once
+file_pattern = re.compile(r"File:\s*(\S+)")
 
-    #record location of ranks file given file path
-    ranks_location = os.path.join(file_path, 'ranks.txt')
+# returns a pattern matching any of the given names (a tuple) as a whole word
+# longer names come first, so a name is not matched by a shorter name inside it
+# patterns are kept, since the same players come up again for every model and prompt variant
+@lru_cache(maxsize=1024)
+def names_pattern(names):
+    alternation = '|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+    # whole word matching; lookarounds instead of \b so names ending in '.' (like 'Jr.') still match
+    return re.compile(r'(?<!\w)(?:' + alternation + r')(?!\w)')
+
+# the line that ends the answer format asked for by prompt_builder.build_prompt
+mafia_line_pattern = re.compile(r'Actual+y likely to be Mafia:', re.IGNORECASE)
+
+# The one parser of the answer format (Rank:, the players in order, then the 'Actualy likely to be Mafia' line),
+# used for grading and by player_ranker to stop streams and merge chunks and samples
+# returns (ranking, mafia line): the text from 'Rank:' (or the start) up to the mafia line, and the rest of the mafia line
+# (None if the response has no mafia line), so names mentioned before 'Rank:' or on the mafia line are not ranks
+def ranking_section(response):
+    marker = mafia_line_pattern.search(response)
+    ranking = response if marker is None else response[:marker.start()]
+    rank_start = ranking.find('Rank:')
+    if rank_start != -1:
+        ranking = ranking[rank_start:]
+    mafia_line = None if marker is None else response[marker.end():].split('\n', 1)[0]
+    return ranking, mafia_line
+
+# returns the players in the order a response ranks them, and the players it names as likely Mafia
+# players the ranking never mentions are ranked last, in their original order
+def response_ranking(response, players):
+    pattern = names_pattern(tuple(players))
+    ranking, mafia_line = ranking_section(response)
+    # a single pass over the ranking finds every mention of every player
+    order = list(dict.fromkeys(pattern.findall(ranking)))
+    order += [name for name in players if name not in order]
+    return order, set(pattern.findall(mafia_line or ''))
+
+# returns the players in the order the response lines rank them (see response_ranking)
+def rank_order(response_lines, players):
+    return response_ranking("\n".join(response_lines), players)[0]
+
+# yields the blocks of a ranks file one at a time, as lists of lines
+# blocks are separated by two empty lines (the "\n\n\n" written after each response)
+def iter_blocks(ranks_location):
+    block = []
+    empty_lines = 0
+    with open(ranks_location, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == "":
+                empty_lines += 1
+                if empty_lines == 2:
+                    if block:
+                        yield block
+                    block = []
+                    empty_lines = 0
+                continue
+            # a single empty line belongs to the response
+            if empty_lines and block:
+                block.append("")
+            empty_lines = 0
+            block.append(line)
+    # a last block without the closing empty lines is still a block
+    if block:
+        yield block
 
-    # Check if the 'ranks.txt' file exists in the specified location
-    if os.path.isfile(ranks_location):
-        # Read the contents of the file into a string variable
-        with open(ranks_location, "r") as f:
-            contents = f.read()
+# returns the dictionary of information about one block (a list of lines)
+@instrumentation.timed('parse')
+def parse_block(lines, store=None):
+    # Extract the file name from the first line
+    file_name = file_pattern.search(lines[0]).group(1).strip(".txt")
+
+    # Take the session number from the file name (the model's response may not repeat it, or get it wrong)
+    session = transcript_session(file_name)
+    #session = re.search("Session:\s*(\S+)", lines[1]).group(1)
+
+    # Create a dictionary to store the information for this block
+    dictionary = {"file_name": file_name, "session": session, "round": transcript_round(file_name)}
+
+    # record true if aliases where used for names at prompt time
+    dictionary["names_changed"] = "anonymized" in file_name
+
+    # Extract the list of players from the last line (or the store)
+    if store is not None:
+        from session_store import parse_transcript_name
+        players = store.players(*parse_transcript_name(file_name))
     else:
-        print(f"Error: 'ranks.txt' file not found in {file_path}")
-        return None
-    
-    # Split the contents into list of individual blocks; use tripple new lines as delimiters
-    blocks = re.split("\n\n\n", contents)
+        players_line = lines[-1].strip()
+        players = parse_players(players_line)
 
-    #pprint(blocks[0]) #debugging: print first block as a sample
-    
-    # Initialize an empty dictionary to store the dictionaries for each block
-    sessions = {}
-    
-    # Iterate over each block and extract the relevant information
-    for block in blocks[:-1]:
+    #mafia list
+    mafia_list = [name for name, role in players.items() if role == 'mafia']
+    dictionary["mafia"] = mafia_list
+
+    ### Extract the rank information from the response (the lines between the file name and the players) ###
+    dictionary["ranks"] = rank_order(lines[1:-1], players)
 
-        # Split the block into individual lines using new line characters as delimiters
-        lines = block.split("\n")
+    #find average percentile rank of the mafia and save to dictionary
+    dictionary['avg_mafia_rank'] = average_percentile_rank(mafia_list, dictionary["ranks"])
+    return dictionary
 
-        #debugging: print the contents of the current block
-        #print("Block: ",end='') 
-        #pprint(block)
+# returns the dictionary of information about one response, as parse_block reads it back from ranks.txt
+# (see rank_journal.write_ranks), without the ranks file having to be written first
+def parse_response(transcript_file, response, players, store=None):
+    return parse_block(f"File: {transcript_file}\n{response}\n{players}".split("\n"), store)
 
+# yields the dictionary of each session in a ranks file, one at a time, in file order
+# the file is read line by line, so memory use does not grow with the file
+# if a session store is given (see session_store.py) the player roles are read from it
+# instead of from the last line of each block
+def iter_ranks_file(ranks_location, store=None):
+    for lines in iter_blocks(ranks_location):
         '''
-        This try catch statement will attempt to break the block string into multiple varaibles.
+        This try catch statement will attempt to break the block into multiple varaibles.
         If the text found is not exactly as expected it will throw an error.
         If that happens a message will be shown and the block will not be recorded
-        and this session will be marked
         '''
         try:
-            # Extract the file name from the first line
-            file_name = re.search("File:\s*(\S+)", lines[0]).group(1).strip(".txt")
-
-            #print(f"parsing file:{file_name}...",end="")
-            #pprint(f"contents: \n{lines}")
-            
-            # Extract the session number from the second line
-            session = int(re.search(r'\d+', lines[1]).group(0))
-            #session = re.search("Session:\s*(\S+)", lines[1]).group(1)
-            #print(session,end=', ')
-            
-            # Create a dictionary to store the information for this block
-            dictionary = {"file_name": file_name, "session": session}
-
-            # record true if aliases where used for names at prompt time
-            dictionary["names_changed"] = "anonymized" in file_name
-            
-            # Extract the list of players from the last line
-            players_line = lines[-1].strip()
-            players = parse_players(players_line) #re.search("\[(.*?)\]", players_line).group(1)
-            #dictionary["Players"] = players #{player: role for player, role in zip(players, ["town" if i % 2 == 0 else "mafia" for i in range(len(players))])}
-            
-            #mafia list
-            mafia_list = [name for name, role in players.items() if role == 'mafia']
-            dictionary["mafia"] = mafia_list
-            
-            ### Extract the rank information from the block ###
-            ranks = []
-            n=0
-            for name in players:
-                # find first mention of name. 
-                if re.search(r'\b' + re.escape(name) + r'\b', block):  # \b ensures whole word matching
-                    ranks.insert(n, name) # add name to the list in the correct position
-                    n+=1
-            
-            #Sort ranks dictionary
-            #ranks = {k: v for k, v in sorted(ranks.items(), key=lambda item: item[1])}
+            yield parse_block(lines, store)
+        except Exception as e:
+            from pprint import pprint # Helps debug dictionaries by displaying them nicely
+            print(f"Could not parse this block: {str(e)}")
+            pprint("\n".join(lines))
 
-            # save ranks to dictionary.
-            dictionary["ranks"] = ranks
+# given file path, return dictionary with file info
+# ranks_name picks another ranks file in the folder, such as the ranks_<model>_<variant>.txt of a sweep
+# store: read the player roles from a session store (see iter_ranks_file)
+def read_ranks_file(file_path, ranks_name='ranks.txt', store=None):
 
-            #debugging: print the contents of the ranks list
-            #print("Ranks: ",end='')
-            #print(ranks)
-            
-            #find average percentile rank of the mafia and save to dictionary
-            dictionary['avg_mafia_rank']= average_percentile_rank(mafia_list,ranks)
-            
-            # Add this files dictionary to the dictionary of sessions
-            sessions[file_name]=dictionary
+    #record location of ranks file given file path
+    ranks_location = os.path.join(file_path, ranks_name)
 
-            #print(f"parsed:{file_name}",end=". ") #debugging
-        except Exception as e:
-            print(f"Could not parse this block: {str(e)}")
-            pprint(block)
-            
+    # Check if the ranks file exists in the specified location
+    if not os.path.isfile(ranks_location):
+        print(f"Error: '{ranks_name}' file not found in {file_path}")
+        return None
+    
+    # Add each file's dictionary to the dictionary of sessions
+    sessions = {}
+    for dictionary in iter_ranks_file(ranks_location, store):
+        sessions[dictionary["file_name"]] = dictionary
         
-    return {k: v for k, v in sorted(sessions.items(), key=lambda item: item[1]['session'])} # return session sorted by session num
+    return {k: v for k, v in sorted(sessions.items(), key=lambda item: (transcript_session(item[0]), transcript_round(item[0])))} # return session sorted by session num
 "---"
 
 
+### Grading many sessions at once ###
+# The parsed sessions are turned into matrices with one row per session and one column per rank position,
+# so every metric is computed for all sessions in a few array operations
+
+# Returns (info, is_mafia, valid)
+#   info: DataFrame with the file_name, session, round and names_changed of each session
+#   is_mafia: (sessions x positions) bool matrix, True where the player ranked at that position is mafia
+#   valid: (sessions x positions) bool matrix, False for the padding after a session's last player
+# sessions is any iterable of the dictionaries made by parse_block (e.g. iter_ranks_file)
+def rank_matrices(sessions):
+    import numpy as np
+    import pandas as pd
+    sessions = list(sessions)
+    width = max((len(session['ranks']) for session in sessions), default=0)
+    is_mafia = np.zeros((len(sessions), width), dtype=bool)
+    valid = np.zeros((len(sessions), width), dtype=bool)
+    for row, session in enumerate(sessions):
+        mafia = set(session['mafia'])
+        is_mafia[row, :len(session['ranks'])] = [name in mafia for name in session['ranks']]
+        valid[row, :len(session['ranks'])] = True
+    info = pd.DataFrame({
+        'file_name': [session['file_name'] for session in sessions],
+        'session': [session['session'] for session in sessions],
+        'round': [session.get('round', 1) for session in sessions],
+        'names_changed': [session['names_changed'] for session in sessions],
+    })
+    return info, is_mafia, valid
+
+# Returns a DataFrame of metrics with one row per session:
+#   players, mafia: number of players and of mafia
+#   percentile_rank: average percentile rank of the mafia (as average_percentile_rank, lower is better)
+#   precision@k: share of mafia among the top k ranked players, for each k in ks
+#   r_precision: share of mafia among the top (number of mafia) ranked players
+#   auc: chance that a random mafia is ranked above a random town player (0.5 is guessing)
+#   average_precision: mean of the precision at each mafia's position
+# Metrics that need both mafia and town players are NaN when a session lacks either
+@instrumentation.timed('grading')
+def session_metrics(sessions, ks=(1, 2, 3)):
+    import numpy as np
+    info, is_mafia, valid = rank_matrices(sessions)
+    positions = np.arange(is_mafia.shape[1])
+    players = valid.sum(axis=1)
+    mafia = is_mafia.sum(axis=1)
+    town_matrix = valid & ~is_mafia
+    town = players - mafia
+    mafia_seen = np.cumsum(is_mafia, axis=1) # mafia ranked at or above each position
+    town_before = np.cumsum(town_matrix, axis=1) - town_matrix # town ranked above each position
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = info.copy()
+        metrics['players'] = players
+        metrics['mafia'] = mafia
+        metrics['percentile_rank'] = np.where(mafia > 0, (is_mafia * positions).sum(axis=1) / mafia / players * 100, np.nan)
+        for k in ks:
+            precision = mafia_seen[:, k - 1] / k if k <= len(positions) else np.nan
+            metrics[f'precision@{k}'] = np.where(players >= k, precision, np.nan)
+        if len(positions):
+            r_precision = mafia_seen[np.arange(len(mafia)), np.clip(mafia - 1, 0, None)] / mafia
+            metrics['r_precision'] = np.where(mafia > 0, r_precision, np.nan)
+        else:
+            metrics['r_precision'] = np.nan
+        metrics['auc'] = np.where((mafia > 0) & (town > 0), (is_mafia * (town[:, None] - town_before)).sum(axis=1) / (mafia * town), np.nan)
+        metrics['average_precision'] = np.where(mafia > 0, (is_mafia * mafia_seen / (positions + 1)).sum(axis=1) / mafia, np.nan)
+    return metrics
+
+# the metric columns made by session_metrics
+def metric_columns(metrics):
+    return [column for column in metrics.columns if column not in ('model', 'file_name', 'session', 'round', 'names_changed', 'players', 'mafia')]
+
+# Returns the mean of each column of values (sessions x metrics) and its bootstrap confidence interval
+# Each resample is stored as how many times it draws each session, so the means of every resample and metric
+# come from one matrix product; resamples are drawn in chunks that keep memory bounded
+def bootstrap(values, n_boot=1000, confidence=0.95, seed=0, chunk_elements=2_000_000):
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    sessions = len(values)
+    observed = ~np.isnan(values) # NaN metrics are left out of the means
+    filled = np.where(observed, values, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = filled.sum(axis=0) / observed.sum(axis=0)
+        if sessions < 2:
+            return mean, mean.copy(), mean.copy()
+        rng = np.random.default_rng(seed)
+        chunk = max(1, chunk_elements // sessions)
+        resampled_means = np.empty((n_boot, values.shape[1]))
+        for start in range(0, n_boot, chunk):
+            size = min(chunk, n_boot - start)
+            samples = rng.integers(0, sessions, size=(size, sessions))
+            # counts[i, j]: times resample i drew session j
+            counts = np.bincount((samples + np.arange(size)[:, None] * sessions).ravel(), minlength=size * sessions)
+            counts = counts.reshape(size, sessions).astype(float)
+            resampled_means[start:start + size] = (counts @ filled) / (counts @ observed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # all-NaN metrics give NaN
+        tail = (1 - confidence) / 2 * 100
+        low, high = np.nanpercentile(resampled_means, [tail, 100 - tail], axis=0)
+    return mean, low, high
+
+# Returns a tidy DataFrame (model, condition, metric, mean, ci_low, ci_high, n) summarizing session metrics
+#   condition 'named' / 'anonymized': transcripts with real names / with aliases
+#   condition 'anonymized - named': the per session (and round) difference, for sessions ranked both ways
+@instrumentation.timed('bootstrap')
+def summarize(metrics, n_boot=1000, confidence=0.95, seed=0):
+    import numpy as np
+    import pandas as pd
+    if 'model' not in metrics:
+        metrics = metrics.assign(model='')
+    # the session and round are taken from the file name, as parse_block does, so pairs never rest on the response
+    metrics = metrics.assign(session=metrics['file_name'].map(transcript_session), round=metrics['file_name'].map(transcript_round))
+    columns = metric_columns(metrics)
+    rows = []
+    for model, model_metrics in metrics.groupby('model', sort=False):
+        named = model_metrics[~model_metrics['names_changed']]
+        anonymized = model_metrics[model_metrics['names_changed']]
+        # pair each round's named and anonymized ranking (the last one, if a round was ranked twice)
+        keys = ['session', 'round']
+        pairs = pd.merge(named.drop_duplicates(keys, keep='last'), anonymized.drop_duplicates(keys, keep='last'),
+                         on=keys, suffixes=('_named', '_anonymized'))
+        conditions = {
+            'named': named[columns].to_numpy(dtype=float),
+            'anonymized': anonymized[columns].to_numpy(dtype=float),
+            'anonymized - named': (pairs[[column + '_anonymized' for column in columns]].to_numpy(dtype=float)
+                                   - pairs[[column + '_named' for column in columns]].to_numpy(dtype=float)),
+        }
+        for condition, values in conditions.items():
+            mean, low, high = bootstrap(values.reshape(-1, len(columns)), n_boot, confidence, seed)
+            counts = (~np.isnan(values)).sum(axis=0) if len(values) else np.zeros(len(columns), dtype=int)
+            for column, column_mean, column_low, column_high, count in zip(columns, mean, low, high, counts):
+                rows.append({'model': model, 'condition': condition, 'metric': column, 'mean': column_mean,
+                             'ci_low': column_low, 'ci_high': column_high, 'n': int(count)})
+    return pd.DataFrame(rows, columns=['model', 'condition', 'metric', 'mean', 'ci_low', 'ci_high', 'n'])
+
+# Grades one or more ranks files
+# ranks_files: a dictionary of model (or any label) -> ranks file location
+# returns (per session metrics, tidy summary with bootstrap confidence intervals)
+def grade(ranks_files, ks=(1, 2, 3), n_boot=1000, confidence=0.95, seed=0, store=None):
+    import pandas as pd
+    frames = []
+    for model, ranks_location in ranks_files.items():
+        metrics = session_metrics(iter_ranks_file(ranks_location, store), ks)
+        metrics.insert(0, 'model', model)
+        frames.append(metrics)
+    metrics = pd.concat(frames, ignore_index=True)
+    return metrics, summarize(metrics, n_boot, confidence, seed)
+
+
+# command line usage:
+#   python rank_grader.py transcripts_new --metrics
+#   python mafia_eval.py grade transcripts_new --metrics
+command_description = "Parse (and grade) the ranks file of a transcripts folder"
+
+def add_arguments(parser):
+    parser.add_argument('transcripts_folder', nargs='?', default=transcripts_folder)
+    parser.add_argument('--ranks-name', default='ranks.txt', help="ranks file in the folder to read")
+    parser.add_argument('--store', default=None, help="read the player roles from this session store")
+    parser.add_argument('--metrics', action='store_true', help="show the metrics and their confidence intervals instead of the parsed sessions")
+
+def run_command(args):
+    # both the metrics and the listing need the ranks file
+    if not os.path.isfile(os.path.join(args.transcripts_folder, args.ranks_name)):
+        print(f"Error: '{args.ranks_name}' file not found in {args.transcripts_folder}")
+        return
+    store = None
+    if args.store is not None:
+        from session_store import SessionStore
+        store = SessionStore(args.store)
+    if args.metrics:
+        metrics, summary = grade({args.transcripts_folder: os.path.join(args.transcripts_folder, args.ranks_name)}, store=store)
+        print(summary.pivot_table(index=['model', 'metric'], columns='condition', values='mean'))
+    else:
+        from pprint import pprint
+        parsed_content = read_ranks_file(args.transcripts_folder, args.ranks_name, store)
+        pprint(parsed_content)
+
 # run the code
-parsed_content = read_ranks_file(transcripts_folder)
-pprint(parsed_content)
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=command_description)
+    add_arguments(parser)
+    run_command(parser.parse_args())
 
 #pandas
 #ranks_df = pd.DataFrame.from_dict(parsed_content, orient='index')
 #ranks_df.set_index(['session','file_name']).sort_values(by='session')
+
+# all metrics, with confidence intervals
+#metrics, summary = grade({'llama3.2': os.path.join(transcripts_folder, 'ranks.txt')})
+#print(summary.pivot_table(index=['model', 'metric'], columns='condition', values='mean'))
@@ -0,0 +1,66 @@
+
+# An append-only record of finished ranking prompts, so an interrupted run can pick up where it stopped
+# Each line of the journal is one JSON record, flushed to disk before the next prompt is recorded
+
+## imports ##
+import os
+import json
+import time
+
+
+# returns the journal location for a ranks file in a transcripts folder (ranks.txt -> ranks.jsonl)
+def journal_location(transcripts_folder, ranks_name='ranks.txt'):
+    return os.path.join(transcripts_folder, os.path.splitext(ranks_name)[0] + '.jsonl')
+
+# empties the journal, for a run that starts from scratch
+def clear_journal(journal_path):
+    with open(journal_path, 'w'):
+        pass
+
+# returns a dictionary (by file) of the records journaled for the given model
+# a later record for the same file replaces an earlier one
+def read_journal(journal_path, model_name):
+    records = {}
+    if not os.path.isfile(journal_path):
+        return records
+    with open(journal_path, 'r') as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line is cut short if the run was killed while writing it
+                continue
+            if record.get('model') == model_name:
+                records[record['file']] = record
+    return records
+
+# opens the journal to add records to
+# a last line cut short by a killed run is ended first, so the next record starts on a line of its own
+def open_journal(journal_path):
+    if os.path.isfile(journal_path) and os.path.getsize(journal_path) > 0:
+        with open(journal_path, 'rb+') as journal:
+            journal.seek(-1, os.SEEK_END)
+            if journal.read(1) != b'\n':
+                journal.write(b'\n')
+    return open(journal_path, 'a')
+
+# adds a finished transcript to an open journal and makes sure it reaches the disk
+# usage holds the token counts and timings of the response (none for cached responses)
+def append_record(journal, model_name, transcript_file, response, players, usage=None):
+    record = {'file': transcript_file, 'model': model_name, 'response': response, 'players': players, 'time': time.time()}
+    if usage is not None:
+        record['usage'] = usage
+    journal.write(json.dumps(record) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+# writes ranks.txt from the journaled records, in the order of transcript_files
+# the file is replaced in one step, so a crash never leaves half a ranks.txt behind
+def write_ranks(records, transcript_files, ranks_path):
+    temporary_path = ranks_path + '.tmp'
+    with open(temporary_path, 'w') as output_file:
+        for transcript_file in transcript_files:
+            if transcript_file in records:
+                record = records[transcript_file]
+                output_file.write(f"File: {transcript_file}\n{record['response']}\n{record['players']}\n\n\n")
+    os.replace(temporary_path, ranks_path)
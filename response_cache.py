@@ -0,0 +1,102 @@
+
+# An on-disk cache of model responses, so reranking unchanged transcripts costs no GPU time
+# Responses are stored in SQLite under a hash of the model name, model digest, exact prompt and generation options
+
+## imports ##
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+default_cache_path = os.path.join('.', 'cache', 'responses.sqlite')
+
+
+# returns the cache key for a model, prompt and the options it was generated with (num_ctx, temperature, seed...)
+# the digest changes whenever the model is updated, so a re-pulled model gets new answers
+# a prompt sent without options keeps the key it had before options were part of it
+def cache_key(model_name, model_digest, prompt, options=None):
+    key = [model_name, model_digest, prompt] + ([options] if options else [])
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+# Stores model responses on disk
+#   max_age_days: entries older than this are removed
+#   max_bytes: once the stored responses add up to more than this, the least recently used are removed
+# hits and misses count the lookups made since the cache was opened
+class ResponseCache:
+    def __init__(self, path=default_cache_path, max_age_days=90, max_bytes=256 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # the connection is shared by the ranking threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL
+            )''')
+        self.connection.commit()
+        self.evict()
+
+    # returns the saved response, or None if there is none
+    def get(self, model_name, model_digest, prompt, options=None):
+        key = cache_key(model_name, model_digest, prompt, options)
+        with self.lock:
+            row = self.connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    # saves a response (replacing any older one for the same key)
+    def put(self, model_name, model_digest, prompt, response, options=None):
+        key = cache_key(model_name, model_digest, prompt, options)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model_name, response, len(response.encode()), now, now))
+            self.connection.commit()
+
+    # removes entries that are too old, then the least recently used until under max_bytes
+    def evict(self):
+        with self.lock:
+            if self.max_age_days is not None:
+                oldest = time.time() - self.max_age_days * 24 * 60 * 60
+                self.connection.execute('DELETE FROM responses WHERE created < ?', (oldest,))
+            if self.max_bytes is not None:
+                total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self.connection.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall()
+                    removed = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        removed.append((key,))
+                        total -= size
+                    self.connection.executemany('DELETE FROM responses WHERE key = ?', removed)
+            self.connection.commit()
+
+    # removes every entry
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+
+    def stats(self):
+        return f"cache: {self.hits} hits, {self.misses} misses ({self.path})"
+
+    def close(self):
+        self.evict()
+        self.connection.close()
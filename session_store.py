@@ -0,0 +1,211 @@
+
+# A columnar store of every session, shared by transcript building, prompt building and grading
+# The sessions are saved as two Arrow IPC files:
+#   lines.arrow: one row per transcript line (session, round, position, phase, kind, speaker, target, message, aliases, roles, lines)
+#   players.arrow: one row per player of each round (session, round, position, name, alias, role)
+# Rows are sorted by session and round, and every round of a game (see transcript_maker.extract_rounds) is a transcript
+# Both are memory-mapped when opened, so loading a session reads no more than its own rows and copies nothing
+
+# pyarrow is needed for the store (pip install pyarrow)
+
+## imports ##
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import transcript_maker
+
+store_folder = './session_store'
+
+lines_schema = pa.schema([
+    ('session', pa.int32()),
+    ('round', pa.int32()),
+    ('position', pa.int32()),
+    ('phase', pa.string()),
+    ('kind', pa.string()),
+    ('speaker', pa.string()),
+    ('speaker_alias', pa.string()),
+    ('speaker_role', pa.string()),
+    ('target', pa.string()),
+    ('target_alias', pa.string()),
+    ('message', pa.string()),
+    ('line', pa.string()),
+    ('anonymized_line', pa.string()),
+])
+players_schema = pa.schema([
+    ('session', pa.int32()),
+    ('round', pa.int32()),
+    ('position', pa.int32()),
+    ('name', pa.string()),
+    ('alias', pa.string()),
+    ('role', pa.string()),
+])
+
+
+# returns (session number, anonymized, round) for a transcript name like 'session_12_anonymized.txt'
+# or 'session_12_round_3.txt' (see transcript_maker.transcript_file_name)
+def parse_transcript_name(file_name):
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    anonymized = name.endswith('_anonymized')
+    return transcript_maker.transcript_session(name), anonymized, transcript_maker.transcript_round(name)
+
+# returns the transcript name of a round ('session_12.txt', 'session_12_anonymized.txt', 'session_12_round_3.txt', ...)
+def transcript_name(session, anonymized=False, round_number=1):
+    return transcript_maker.transcript_file_name(session, round_number, anonymized)
+
+# Returns the (lines, players) DataFrames of one round (as transcript_maker.extract_rounds yields it)
+def round_frames(session_num, round_number, lines, player_roles, anonymized_player_roles, aliases):
+    lines = lines.copy()
+    lines.insert(0, 'session', session_num)
+    lines.insert(1, 'round', round_number)
+    lines.insert(2, 'position', np.arange(len(lines)))
+    lines.insert(3, 'phase', f'day {round_number}')
+    lines['speaker_alias'] = lines['speaker'].map(aliases)
+    lines['speaker_role'] = lines['speaker'].map(player_roles)
+    lines['target_alias'] = lines['target'].map(aliases)
+
+    # players in the order of the transcript's 'Players:' line
+    names = list(player_roles)
+    players = pd.DataFrame({
+        'session': session_num,
+        'round': round_number,
+        'position': np.arange(len(names)),
+        'name': names,
+        'alias': [aliases[name] for name in names],
+        'role': [player_roles[name] for name in names],
+    })
+    return lines, players
+
+# writes a DataFrame as an uncompressed Arrow IPC file (uncompressed so it can be memory-mapped)
+def write_table(frame, schema, path):
+    table = pa.Table.from_pandas(frame[schema.names], schema=schema, preserve_index=False)
+    temporary_path = path + '.tmp'
+    with pa.OSFile(temporary_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary_path, path)
+
+# Builds the session store from the dataset
+# The transcripts folder is brought up to date first (as transcript_maker.process_transmissions does), and the rounds
+# its build extracts are the ones the store gets, so every session is read once and the store and the transcripts agree
+# Only the sessions that were rebuilt, or are missing from the store, are extracted: the rows of the others are kept,
+# and the store is not written at all when nothing changed
+def ingest(dataset_folder=transcript_maker.dataset_folder, transcripts_folder=transcript_maker.transcripts_folder, store_path=store_folder,
+           workers=1, force=False):
+    manifest, directories, jobs = transcript_maker.plan_sessions(dataset_folder, transcripts_folder, force)
+    entries = manifest['sessions']
+    lines_path = os.path.join(store_path, 'lines.arrow')
+    players_path = os.path.join(store_path, 'players.arrow')
+
+    # a store from before rounds were stored is built again
+    old = None
+    if not force and os.path.exists(lines_path) and os.path.exists(players_path):
+        old = SessionStore(store_path)
+        if not (old.lines.schema.equals(lines_schema) and old.players_table.schema.equals(players_schema)):
+            old = None
+    stored = set(old.sessions()) if old is not None else set()
+
+    # the sessions to rebuild, and the up to date ones whose rows are not in the store
+    # (their transcripts are written again, the same since the seed is the manifest's)
+    keys = jobs + [key for key, entry in entries.items() if key not in jobs and entry['outputs'] and entry['session'] not in stored]
+    results = transcript_maker.build_sessions(manifest, directories, keys, transcripts_folder, workers, keep_rounds=True)
+    transcript_maker.write_manifest(transcripts_folder, manifest)
+
+    wanted = set(entry['session'] for entry in entries.values() if entry['outputs'])
+    kept = wanted - set(entries[key]['session'] for key in keys)
+    if not keys and stored == wanted:
+        print(f"Session store up to date: {len(stored)} sessions, {len(old.rounds()) if old is not None else 0} rounds. See {store_path}")
+        return
+
+    frames = [round_frames(entries[key]['session'], *extracted) for key, (written, rounds) in zip(keys, results) for extracted in rounds]
+    if old is not None and kept:
+        old_lines, old_players = old.to_pandas()
+        frames.append((old_lines[old_lines['session'].isin(kept)], old_players[old_players['session'].isin(kept)]))
+    old = None
+
+    os.makedirs(store_path, exist_ok=True)
+    if frames:
+        lines = pd.concat([lines for lines, players in frames], ignore_index=True)
+        players = pd.concat([players for lines, players in frames], ignore_index=True)
+        lines = lines.sort_values(['session', 'round', 'position'], kind='stable', ignore_index=True)
+        players = players.sort_values(['session', 'round', 'position'], kind='stable', ignore_index=True)
+    else:
+        lines = pd.DataFrame(columns=lines_schema.names)
+        players = pd.DataFrame(columns=players_schema.names)
+    write_table(lines, lines_schema, lines_path)
+    write_table(players, players_schema, players_path)
+    rounds = len(players[['session', 'round']].drop_duplicates())
+    print(f"Session store written: {players['session'].nunique()} sessions ({len(keys)} extracted), {rounds} rounds, {len(lines)} lines. "
+          f"See {store_path}")
+
+# memory-maps an Arrow IPC file and returns its table (no data is copied)
+def read_table(path):
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+# returns a dictionary of (session number, round) -> (first row, number of rows) for a table sorted by session and round
+def session_offsets(table):
+    keys = table.column('session').to_numpy().astype(np.int64) << 32 | table.column('round').to_numpy().astype(np.int64)
+    numbers, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    return {(int(number >> 32), int(number & 0xFFFFFFFF)): (int(start), int(count)) for number, start, count in zip(numbers, starts, counts)}
+
+# Read access to a session store
+class SessionStore:
+    def __init__(self, store_path=store_folder):
+        self.lines = read_table(os.path.join(store_path, 'lines.arrow'))
+        self.players_table = read_table(os.path.join(store_path, 'players.arrow'))
+        self.line_offsets = session_offsets(self.lines)
+        self.player_offsets = session_offsets(self.players_table)
+
+    # returns the session numbers in the store
+    def sessions(self):
+        return sorted(set(session for session, round_number in self.player_offsets))
+
+    # returns the (session number, round) of every round in the store
+    def rounds(self):
+        return sorted(self.player_offsets)
+
+    # returns the transcript names of every round, sorted like player_ranker.transcript_list
+    def transcript_names(self):
+        return sorted(transcript_name(session, anonymized, round_number) for session, round_number in self.rounds() for anonymized in (False, True))
+
+    # returns the lines of one round as an Arrow table (a zero-copy slice of the store)
+    def session_lines(self, session, round_number=1):
+        start, count = self.line_offsets[(session, round_number)]
+        return self.lines.slice(start, count)
+
+    # returns the players of one round as an Arrow table (a zero-copy slice of the store)
+    def session_players(self, session, round_number=1):
+        start, count = self.player_offsets[(session, round_number)]
+        return self.players_table.slice(start, count)
+
+    # returns the transcript text of a round as player_ranker.prompt_maker reads it from the file
+    # (every line followed by a new line, without the 'Players:' line)
+    def transcript(self, session, anonymized=False, round_number=1):
+        column = 'anonymized_line' if anonymized else 'line'
+        return ''.join(line + '\n' for line in self.session_lines(session, round_number).column(column).to_pylist())
+
+    # returns a dictionary of the round's players (or their aliases) and their roles
+    # (the arguments are those parse_transcript_name returns)
+    def players(self, session, anonymized=False, round_number=1):
+        players = self.session_players(session, round_number)
+        names = players.column('alias' if anonymized else 'name').to_pylist()
+        return dict(zip(names, players.column('role').to_pylist()))
+
+    # returns the whole store as pandas DataFrames (lines, players)
+    def to_pandas(self):
+        return self.lines.to_pandas(), self.players_table.to_pandas()
+
+
+# command line usage:
+#   python session_store.py --workers 8
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the columnar session store from the dataset")
+    parser.add_argument('dataset_folder', nargs='?', default=transcript_maker.dataset_folder)
+    parser.add_argument('transcripts_folder', nargs='?', default=transcript_maker.transcripts_folder)
+    parser.add_argument('--store', default=store_folder, help="folder to write the store to")
+    parser.add_argument('--workers', type=int, default=1, help="sessions read in parallel processes")
+    parser.add_argument('--force', action='store_true', help="rebuild every session, even those that are up to date")
+    args = parser.parse_args()
+    ingest(args.dataset_folder, args.transcripts_folder, args.store, workers=args.workers, force=args.force)
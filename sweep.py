@@ -0,0 +1,118 @@
+
+# Runs every model over every transcripts folder and prompt variant as one scheduled job
+# Jobs are grouped by model, so the server pulls and loads each model once,
+# starting with whichever model the server already has loaded
+
+# usage: python sweep.py --models mistral qwq --folders transcripts_a transcripts_b --workers 4
+
+## imports ##
+import time
+import argparse
+from functools import partial
+import backends
+import player_ranker
+import prompt_builder
+
+# prompt builders a sweep can compare, by name
+# each takes a transcript file location and returns (prompt, Players) like player_ranker.prompt_maker
+prompt_variants = {
+    'default': player_ranker.prompt_maker,
+    'verbose': partial(player_ranker.prompt_maker, builder=prompt_builder.verbose_prompt),
+}
+
+
+# returns the ranks file name for one model and prompt variant (e.g. ranks_llama3.2_default.txt)
+def ranks_file_name(model_name, variant):
+    return f"ranks_{model_name.replace(':', '-').replace('/', '-')}_{variant}.txt"
+
+# returns the sweep plan: a list of (model, jobs) with one job per (folder, variant)
+# all of a model's jobs run back to back, and models already loaded on the server go first
+def schedule(models, folders, variants, loaded=()):
+    loaded = set(loaded)
+    ordered = [model for model in models if backends.full_model_name(model) in loaded]
+    ordered += [model for model in models if backends.full_model_name(model) not in loaded]
+    jobs = [(folder, variant) for folder in folders for variant in variants]
+    return [(model, jobs) for model in ordered]
+
+# Inputs: lists of model names and transcripts folders (and optionally prompt variant names)
+# ranks every folder with every model and variant, writing ranks_<model>_<variant>.txt in each folder
+# returns a report per model: jobs run, queue time, wall-clock time, prompts sent and tokens/sec
+# every job shares one backend (see backends.py), an Ollama server at host unless another is given
+def sweep(models, folders, variants=None, workers=1, timeout=120, retries=0, host=player_ranker.local_host, cache=True, resume=False, stream=False, backend=None):
+    if variants is None:
+        variants = ['default']
+    for variant in variants:
+        if variant not in prompt_variants:
+            raise ValueError(f"Unknown prompt variant '{variant}', expected one of {list(prompt_variants)}")
+
+    if backend is None:
+        backend = backends.OllamaBackend(host=host, timeout=timeout, pool_size=max(1, workers))
+    plan = schedule(models, folders, variants, backend.loaded_models())
+    print("Sweep plan:")
+    for model_name, jobs in plan:
+        print(f"  {model_name}: {len(jobs)} jobs")
+
+    sweep_start = time.perf_counter()
+    reports = []
+    for model_name, jobs in plan:
+        # time this model spent waiting on the models before it
+        model_start = time.perf_counter()
+        queue_seconds = model_start - sweep_start
+
+        # pull once for all of this model's jobs
+        print(f"Pulling model: {model_name}")
+        backend.pull(model_name)
+
+        summaries = []
+        for folder, variant in jobs:
+            print(f"Ranking {folder} with {model_name} ({variant} prompt)")
+            summary = player_ranker.ollama_rank(model_name, folder, workers=workers, timeout=timeout, retries=retries,
+                                                host=host, cache=player_ranker.default_cache if cache else None, resume=resume,
+                                                prompt_function=prompt_variants[variant],
+                                                ranks_name=ranks_file_name(model_name, variant), pull=False, stream=stream,
+                                                backend=backend)
+            if summary is not None:
+                summaries.append(summary)
+
+        eval_tokens = sum(summary['eval_tokens'] for summary in summaries)
+        eval_seconds = sum(summary['eval_seconds'] for summary in summaries)
+        reports.append({
+            'model': model_name,
+            'jobs': len(summaries),
+            'queue_seconds': queue_seconds,
+            'seconds': time.perf_counter() - model_start,
+            'prompted': sum(summary['prompted'] for summary in summaries),
+            'cached': sum(summary['cached'] for summary in summaries),
+            'eval_tokens': eval_tokens,
+            'tokens_per_second': eval_tokens / eval_seconds if eval_seconds else 0.0,
+        })
+
+    print_report(reports, time.perf_counter() - sweep_start)
+    return reports
+
+# prints the per model reports as a table
+def print_report(reports, total_seconds):
+    print(f"\n{'model':<24}{'jobs':>6}{'queued (s)':>12}{'wall (s)':>10}{'prompted':>10}{'cached':>8}{'tokens/s':>10}")
+    for report in reports:
+        print(f"{report['model']:<24}{report['jobs']:>6}{report['queue_seconds']:>12.1f}{report['seconds']:>10.1f}"
+              f"{report['prompted']:>10}{report['cached']:>8}{report['tokens_per_second']:>10.1f}")
+    print(f"Sweep complete in {total_seconds:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank every transcripts folder with every model")
+    parser.add_argument('--models', nargs='+', required=True)
+    parser.add_argument('--folders', nargs='+', required=True)
+    parser.add_argument('--variants', nargs='+', default=['default'], choices=list(prompt_variants))
+    parser.add_argument('--workers', type=int, default=1, help="prompts sent to the server at once")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait on each prompt")
+    parser.add_argument('--retries', type=int, default=0, help="times to retry a failed prompt")
+    parser.add_argument('--host', default=player_ranker.local_host)
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="do not read or save cached responses")
+    parser.add_argument('--resume', action='store_true', help="skip the transcripts each job has already journaled")
+    parser.add_argument('--stream', action='store_true', help="stream responses and stop each once its ranking is complete")
+    parser.add_argument('--backend', default='ollama', choices=list(backends.backend_types), help="model server to prompt ('fake' answers in process)")
+    args = parser.parse_args()
+    backend = None if args.backend == 'ollama' else backends.make_backend(args.backend)
+    sweep(args.models, args.folders, args.variants, workers=args.workers, timeout=args.timeout, retries=args.retries,
+          host=args.host, cache=args.cache, resume=args.resume, stream=args.stream, backend=backend)
@@ -0,0 +1,55 @@
+# Shared fixtures and options of the test suite
+# The modules live at the top of the repository, so it is put on the path to import them as the scripts do
+# The modules default to folders relative to the working directory, so the tests pass every path they use
+# The benchmarks (tests/test_benchmarks.py) only run with --benchmarks, and on the 100x and 1000x datasets with --large-scales too:
+#   python -m pytest --benchmarks
+#   python -m pytest --benchmarks --large-scales tests/test_benchmarks.py
+
+import os
+import io
+import sys
+import shutil
+import contextlib
+import pytest
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+import transcript_maker
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmarks', action='store_true', help="run the benchmarks, which are skipped otherwise")
+    parser.addoption('--large-scales', action='store_true', help="run the benchmarks on the 100x and 1000x datasets too")
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "large_scale: a benchmark on a 100x or 1000x dataset, run with --large-scales")
+
+def pytest_collection_modifyitems(config, items):
+    for item in items:
+        if 'benchmark' in getattr(item, 'fixturenames', ()) and not config.getoption('--benchmarks'):
+            item.add_marker(pytest.mark.skip(reason="benchmarks run with --benchmarks"))
+        elif 'large_scale' in item.keywords and not config.getoption('--large-scales'):
+            item.add_marker(pytest.mark.skip(reason="large scales run with --large-scales"))
+
+
+# the dataset/ folder of the repository
+@pytest.fixture(scope='session')
+def dataset_folder():
+    return os.path.join(repository, 'dataset')
+
+# a copy of the first few sessions of dataset/, which a test may change
+@pytest.fixture
+def small_dataset(tmp_path, dataset_folder):
+    folder = tmp_path / 'dataset'
+    for session in transcript_maker.session_directories(dataset_folder)[:3]:
+        shutil.copytree(session, folder / os.path.basename(session))
+    return str(folder)
+
+# the transcripts of small_dataset
+@pytest.fixture
+def small_transcripts(small_dataset, tmp_path):
+    folder = str(tmp_path / 'transcripts')
+    with contextlib.redirect_stdout(io.StringIO()):
+        transcript_maker.process_transmissions(small_dataset, folder)
+    return folder
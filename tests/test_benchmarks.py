@@ -0,0 +1,86 @@
+# Benchmarks of the pipeline's stages on synthetic datasets (see benchmarks.py), run with pytest-benchmark:
+#   python -m pytest tests/test_benchmarks.py --benchmarks --benchmark-autosave
+#   python -m pytest tests/test_benchmarks.py --benchmarks --benchmark-compare --benchmark-compare-fail=mean:20%
+# each runs at 10x the dataset, and at 100x and 1000x as well with --large-scales (see conftest.py)
+# they are skipped without --benchmarks, and when pytest-benchmark is not installed (pip install pytest-benchmark)
+
+import os
+import io
+import random
+import contextlib
+import pandas as pd
+import pytest
+import backends
+import pipeline
+import player_ranker
+import benchmarks
+import rank_grader
+import transcript_maker
+
+pytest.importorskip('pytest_benchmark')
+
+# how many times over the dataset is, for every benchmark
+scales = [10, pytest.param(100, marks=pytest.mark.large_scale), pytest.param(1000, marks=pytest.mark.large_scale)]
+
+
+@pytest.fixture(scope='module', params=scales, ids=lambda scale: f"{scale}x")
+def scale(request):
+    return request.param
+
+# the sorted logs and aliases of every session of a dataset whose chat and vote rows are there `scale` times
+@pytest.fixture(scope='module')
+def enlarged_logs(tmp_path_factory, dataset_folder, scale):
+    folder = benchmarks.enlarged_dataset(dataset_folder, scale, str(tmp_path_factory.mktemp('enlarged')))
+    logs = [pd.read_csv(os.path.join(session, 'info.csv')).sort_values(by='creation_time')
+            for session in transcript_maker.session_directories(folder)]
+    return [(log, transcript_maker.generate_names(log)) for log in logs]
+
+# dataset/ `scale` times over
+@pytest.fixture(scope='module')
+def synthetic_folder(tmp_path_factory, dataset_folder, scale):
+    folder = str(tmp_path_factory.mktemp('synthetic') / f"dataset_{scale}x")
+    benchmarks.synthetic_dataset(dataset_folder, scale, folder)
+    return folder
+
+# the setup of a pedantic benchmark that gives each round an empty transcripts folder
+@pytest.fixture
+def fresh_folder(tmp_path_factory):
+    return lambda: ((str(tmp_path_factory.mktemp('transcripts')),), {})
+
+
+@pytest.mark.benchmark(group='format')
+def test_line_table(benchmark, enlarged_logs):
+    benchmark(lambda: [transcript_maker.line_table(log, aliases) for log, aliases in enlarged_logs])
+
+@pytest.mark.benchmark(group='format')
+def test_row_by_row_formatting(benchmark, enlarged_logs):
+    benchmark.pedantic(lambda: [benchmarks.reference_lines(log, aliases) for log, aliases in enlarged_logs], rounds=3)
+
+@pytest.mark.benchmark(group='build')
+def test_process_transmissions(benchmark, synthetic_folder, fresh_folder):
+    def build(transcripts_folder):
+        with contextlib.redirect_stdout(io.StringIO()):
+            transcript_maker.process_transmissions(synthetic_folder, transcripts_folder)
+    benchmark.pedantic(build, setup=fresh_folder, rounds=3)
+
+@pytest.mark.benchmark(group='pipeline')
+def test_pipeline_fake_model(benchmark, synthetic_folder, fresh_folder):
+    def run(transcripts_folder):
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics, summary, times = pipeline.run_pipeline('fake', synthetic_folder, transcripts_folder, backend=backends.FakeBackend(),
+                                                            cache=None, pull=False)
+        return len(metrics), len(player_ranker.transcript_list(transcripts_folder))
+    graded, transcripts = benchmark.pedantic(run, setup=fresh_folder, rounds=3)
+    assert graded == transcripts > 0
+
+@pytest.mark.benchmark(group='grade')
+def test_session_metrics(benchmark, scale):
+    rng = random.Random(0)
+    sessions = []
+    for number in range(1000 * scale):
+        players = [f"Player_{letter}" for letter in 'ABCDEFGHIJ'[:rng.randint(5, 10)]]
+        rng.shuffle(players)
+        sessions.append({'file_name': f"session_{number}", 'session': number, 'round': 1, 'names_changed': False,
+                         'ranks': players, 'mafia': rng.sample(players, 2)})
+    metrics = benchmark(rank_grader.session_metrics, sessions)
+    assert len(metrics) == len(sessions)
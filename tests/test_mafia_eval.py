@@ -0,0 +1,37 @@
+# Tests of the command line: each command runs its module's run_command with the options it was given
+
+import os
+import pytest
+import mafia_eval
+import player_ranker
+
+
+def test_build_rank_and_grade(small_dataset, tmp_path, capsys):
+    transcripts = str(tmp_path / 'transcripts')
+    mafia_eval.main(['build', small_dataset, transcripts])
+    names = player_ranker.transcript_list(transcripts)
+    assert names
+
+    mafia_eval.main(['rank', 'fake', transcripts, '--backend', 'fake', '--no-cache'])
+    with open(os.path.join(transcripts, 'ranks.txt')) as ranks_file:
+        assert [line[len('File: '):].strip() for line in ranks_file if line.startswith('File: ')] == names
+
+    capsys.readouterr()
+    mafia_eval.main(['grade', transcripts, '--metrics'])
+    assert 'precision@1' in capsys.readouterr().out
+
+def test_pipeline(small_dataset, tmp_path, capsys):
+    transcripts = str(tmp_path / 'transcripts')
+    mafia_eval.main(['pipeline', 'fake', '--dataset', small_dataset, '--transcripts', transcripts, '--backend', 'fake', '--no-cache'])
+    assert 'precision@1' in capsys.readouterr().out
+    assert os.path.isfile(os.path.join(transcripts, 'ranks.jsonl'))
+
+@pytest.mark.parametrize('options', [[], ['--metrics']])
+def test_grade_without_ranks(tmp_path, capsys, options):
+    mafia_eval.main(['grade', str(tmp_path)] + options)
+    assert "Error: 'ranks.txt' file not found" in capsys.readouterr().out
+
+def test_unknown_command(capsys):
+    with pytest.raises(SystemExit):
+        mafia_eval.main(['evaluate'])
+    assert 'invalid choice' in capsys.readouterr().err
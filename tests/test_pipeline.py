@@ -0,0 +1,67 @@
+# Tests of the pipelined run: a failing model must stop the run with its error, not leave the stages waiting on each other
+
+import io
+import threading
+import contextlib
+import pytest
+import backends
+import pipeline
+
+
+class PullFails(backends.FakeBackend):
+    def pull(self, model_name):
+        raise ConnectionError("no model server")
+
+class GenerateFails(backends.FakeBackend):
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        raise ConnectionError("no model server")
+
+class BatchFails(GenerateFails):
+    supports_batch = True
+
+    def generate_batch(self, model_name, prompts, keep_alive=None, options=None, workers=8):
+        raise ConnectionError("no model server")
+
+# runs the pipeline in a thread and returns the exception it raised (None if it finished), failing if it does not end
+def run_with_deadline(dataset, transcripts, backend, seconds=60):
+    outcome = {}
+    def run():
+        try:
+            pipeline.run_pipeline('fake', dataset, transcripts, workers=2, queue_size=1, backend=backend, cache=None)
+            outcome['error'] = None
+        except Exception as e:
+            outcome['error'] = e
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(seconds)
+    assert not thread.is_alive(), "the pipeline hung"
+    return outcome['error']
+
+def test_failed_pull_stops_the_pipeline(small_dataset, tmp_path):
+    error = run_with_deadline(small_dataset, str(tmp_path / 'transcripts'), PullFails())
+    assert isinstance(error, ConnectionError)
+
+# a prompt that fails is reported and skipped (see player_ranker.rank_transcript), and the run still ends
+@pytest.mark.parametrize('backend_type', [GenerateFails, BatchFails])
+def test_failed_generate_ends_the_pipeline(small_dataset, tmp_path, backend_type):
+    error = run_with_deadline(small_dataset, str(tmp_path / 'transcripts'), backend_type())
+    assert error is None
+
+class Counting(backends.FakeBackend):
+    supports_batch = False
+    prompts = 0
+
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        self.prompts += 1
+        return super().generate(model_name, prompt, keep_alive, options)
+
+# a resumed run ranks only the transcripts missing from the journal, and grades them all
+def test_resume(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    with contextlib.redirect_stdout(io.StringIO()):
+        metrics, summary, times = pipeline.run_pipeline('fake', small_dataset, transcripts, backend=Counting(), cache=None)
+        backend = Counting()
+        resumed, summary, times = pipeline.run_pipeline('fake', small_dataset, transcripts, backend=backend, cache=None, resume=True)
+    assert backend.prompts == 0
+    assert len(resumed) == len(metrics) > 0
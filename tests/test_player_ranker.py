@@ -0,0 +1,130 @@
+# Tests of ranking: rank aggregation for self-consistency sampling, resuming from the journal,
+# streaming that stops at the end of the ranking, and chunked transcripts whose rankings are merged
+
+import os
+import numpy as np
+import pytest
+import backends
+import player_ranker
+import prompt_builder
+import rank_grader
+import rank_journal
+
+
+def positions(*orders):
+    # each order lists the players (column numbers) from most to least likely Mafia
+    result = np.empty((len(orders), len(orders[0])))
+    for row, order in enumerate(orders):
+        result[row, order] = np.arange(len(order))
+    return result
+
+def test_unanimous_samples():
+    samples = positions([2, 0, 1], [2, 0, 1], [2, 0, 1])
+    for method in player_ranker.sample_methods:
+        assert player_ranker.aggregate_ranking(samples, method).tolist() == [2, 0, 1]
+
+def test_kemeny_follows_the_majority_where_the_mean_does_not():
+    # two samples rank 0 first, one ranks it last: the mean puts 1 first, but most samples prefer 0 to 1
+    samples = positions([0, 1, 2, 3], [0, 1, 2, 3], [1, 2, 3, 0])
+    assert player_ranker.aggregate_ranking(samples, 'mean').tolist() == [1, 0, 2, 3]
+    assert player_ranker.aggregate_ranking(samples, 'kemeny').tolist() == [0, 1, 2, 3]
+
+def test_kemeny_is_locally_optimal():
+    rng = np.random.default_rng(0)
+    for trial in range(20):
+        samples = positions(*[rng.permutation(7) for sample in range(5)])
+        order = player_ranker.aggregate_ranking(samples, 'kemeny')
+        assert sorted(order.tolist()) == list(range(7))
+        above = (samples[:, :, None] < samples[:, None, :]).mean(axis=0)
+        for first, second in zip(order[:-1], order[1:]):
+            assert above[first, second] >= above[second, first]
+
+def test_sample_agreement():
+    samples = positions([0, 1, 2], [2, 1, 0])
+    assert player_ranker.sample_agreement(samples, np.array([0, 1, 2])).tolist() == [1.0, 0.0]
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        player_ranker.aggregate_ranking(positions([0, 1]), 'median')
+
+
+# a fake model server that is interrupted (like by Ctrl+C) on the prompt after the first `answers`
+class Interrupted(backends.FakeBackend):
+    supports_batch = False
+
+    def __init__(self, answers):
+        super().__init__()
+        self.answers = answers
+        self.prompts = 0
+
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        self.prompts += 1
+        if self.prompts > self.answers:
+            raise KeyboardInterrupt
+        return super().generate(model_name, prompt, keep_alive, options)
+
+# a run interrupted part way leaves its finished transcripts in the journal, and resuming ranks only the rest
+def test_resume_after_interrupt(small_transcripts):
+    transcripts = player_ranker.transcript_list(small_transcripts)
+    with pytest.raises(KeyboardInterrupt):
+        player_ranker.ollama_rank('fake', small_transcripts, backend=Interrupted(3), cache=None)
+    journal_path = rank_journal.journal_location(small_transcripts)
+    assert len(rank_journal.read_journal(journal_path, 'fake')) == 3
+    # a line cut short by the interrupt is skipped
+    with open(journal_path, 'a') as journal:
+        journal.write('{"file": "session_')
+
+    backend = Interrupted(len(transcripts))
+    player_ranker.ollama_rank('fake', small_transcripts, backend=backend, cache=None, resume=True)
+    assert backend.prompts == len(transcripts) - 3
+    assert sorted(rank_journal.read_journal(journal_path, 'fake')) == transcripts
+    with open(os.path.join(small_transcripts, 'ranks.txt')) as ranks_file:
+        assert [line[len('File: '):].strip() for line in ranks_file if line.startswith('File: ')] == transcripts
+
+# a streamed response is cut off once the ranking is complete, leaving out what the model says after it
+def test_stream_stops_after_the_ranking(small_transcripts):
+    transcript_file = player_ranker.transcript_list(small_transcripts)[0]
+    prompt, players = player_ranker.prompt_maker(os.path.join(small_transcripts, transcript_file))
+    backend = backends.FakeBackend(ramble=500)
+    response, usage = player_ranker.rank_transcript('fake', transcript_file, prompt, backend, players=players, stream=True)
+    assert usage['stopped_early']
+    assert 'Explanation' not in response
+    assert usage['eval_count'] < 500
+    order, mafia = rank_grader.response_ranking(response, players)
+    assert order == list(players) and mafia
+    # the whole response, when not streamed
+    response, usage = player_ranker.rank_transcript('fake', transcript_file, prompt, backend, players=players)
+    assert 'Explanation' in response and not usage.get('stopped_early')
+
+# a transcript too long for the context window is split into chunks of whole turns that each fit in it
+def test_chunked_prompts_fit_the_window(small_transcripts):
+    count_tokens = prompt_builder.local_tokenizer()
+    context_tokens = 900
+    builder = prompt_builder.chunked_builder(context_tokens)
+    transcript_file = max(player_ranker.transcript_list(small_transcripts),
+                          key=lambda name: os.path.getsize(os.path.join(small_transcripts, name)))
+    prompts, players = player_ranker.prompt_maker(os.path.join(small_transcripts, transcript_file), builder)
+    assert len(prompts) > 1
+    assert all(count_tokens(prompt) <= context_tokens - prompt_builder.answer_tokens for prompt in prompts)
+    with open(os.path.join(small_transcripts, transcript_file)) as file:
+        turns = prompt_builder.compact_whitespace(''.join(file.readlines()[:-1])).split('\n')
+    assert all(any(turn in prompt for prompt in prompts) for turn in turns)
+    # the chunks are ranked and merged into one response for the transcript
+    response = player_ranker.merge_parts(transcript_file, [backends.stub_answer(prompt) for prompt in prompts], [], players)[0]
+    assert rank_grader.response_ranking(response, players)[0] == list(players)
+
+# chunks are merged by Borda count, ties keep the players' order, and the Mafia are those at least half the chunks name
+def test_borda_merge():
+    players = {'Player_A': 'bystander', 'Player_B': 'mafia', 'Player_C': 'bystander'}
+    def answer(order, mafia):
+        return player_ranker.format_ranking('session_1.txt', order, mafia)
+    responses = [answer(['Player_B', 'Player_A', 'Player_C'], ['Player_B']),
+                 answer(['Player_A', 'Player_B', 'Player_C'], ['Player_A']),
+                 answer(['Player_B', 'Player_C', 'Player_A'], ['Player_B'])]
+    order, mafia = rank_grader.response_ranking(player_ranker.merge_rankings('session_1.txt', responses, players), players)
+    assert order == ['Player_B', 'Player_A', 'Player_C']
+    assert mafia == {'Player_B'}
+    tied = [answer(['Player_A', 'Player_C', 'Player_B'], []), answer(['Player_C', 'Player_A', 'Player_B'], ['Player_C'])]
+    order, mafia = rank_grader.response_ranking(player_ranker.merge_rankings('session_1.txt', tied, players), players)
+    assert order == ['Player_A', 'Player_C', 'Player_B']
+    assert mafia == {'Player_C'}
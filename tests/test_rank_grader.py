@@ -0,0 +1,92 @@
+# Tests of grading: reading the blocks of a ranks file and the metrics of each session
+
+import math
+import pytest
+import rank_grader
+
+
+def write_lines(path, lines):
+    path.write_text('\n'.join(lines))
+    return str(path)
+
+def test_iter_blocks_splits_on_two_empty_lines(tmp_path):
+    path = write_lines(tmp_path / 'ranks.txt', ['File: a', 'one', '', '', 'File: b', 'two', '', ''])
+    assert list(rank_grader.iter_blocks(path)) == [['File: a', 'one'], ['File: b', 'two']]
+
+def test_iter_blocks_keeps_single_empty_lines(tmp_path):
+    path = write_lines(tmp_path / 'ranks.txt', ['File: a', 'one', '', 'two', '', '', 'File: b'])
+    assert list(rank_grader.iter_blocks(path)) == [['File: a', 'one', '', 'two'], ['File: b']]
+
+def test_iter_blocks_last_block_without_closing_lines(tmp_path):
+    path = write_lines(tmp_path / 'ranks.txt', ['File: a', 'one', '', '', 'File: b', 'two'])
+    assert list(rank_grader.iter_blocks(path))[-1] == ['File: b', 'two']
+
+def test_iter_blocks_ignores_extra_empty_lines(tmp_path):
+    path = write_lines(tmp_path / 'ranks.txt', ['', '', '', 'File: a', '', '', '', '', '', 'File: b', '', '', ''])
+    assert list(rank_grader.iter_blocks(path)) == [['File: a'], ['File: b']]
+
+def test_iter_blocks_empty_file(tmp_path):
+    path = write_lines(tmp_path / 'ranks.txt', [])
+    assert list(rank_grader.iter_blocks(path)) == []
+
+
+def session(ranks, mafia, file_name='session_1'):
+    return {'file_name': file_name, 'session': 1, 'round': 1, 'names_changed': False, 'ranks': ranks, 'mafia': mafia}
+
+def test_session_metrics_values():
+    metrics = rank_grader.session_metrics([session(['A', 'B', 'C', 'D'], ['A', 'C'])]).iloc[0]
+    assert metrics['players'] == 4 and metrics['mafia'] == 2
+    assert metrics['percentile_rank'] == pytest.approx(25.0)
+    assert metrics['precision@1'] == pytest.approx(1.0)
+    assert metrics['precision@2'] == pytest.approx(0.5)
+    assert metrics['precision@3'] == pytest.approx(2 / 3)
+    assert metrics['r_precision'] == pytest.approx(0.5)
+    # mafia above town in 3 of the 4 (mafia, town) pairs: A > B, A > D, C > D but not C > B
+    assert metrics['auc'] == pytest.approx(0.75)
+    assert metrics['average_precision'] == pytest.approx((1 + 2 / 3) / 2)
+
+def test_session_metrics_agree_with_average_percentile_rank():
+    sessions = [session(['A', 'B', 'C', 'D', 'E'], ['E']), session(['B', 'A', 'C'], ['A', 'B']), session(['C', 'A', 'B', 'D'], ['D', 'A'])]
+    metrics = rank_grader.session_metrics(sessions)
+    for row, one in zip(metrics.itertuples(), sessions):
+        assert row.percentile_rank == pytest.approx(rank_grader.average_percentile_rank(one['mafia'], one['ranks']))
+
+def test_session_metrics_perfect_and_worst():
+    metrics = rank_grader.session_metrics([session(['A', 'B', 'C'], ['A']), session(['A', 'B', 'C'], ['C'])])
+    assert metrics['auc'].tolist() == [1.0, 0.0]
+    assert metrics['average_precision'].tolist() == pytest.approx([1.0, 1 / 3])
+
+def test_session_metrics_undefined():
+    # no mafia, only mafia, and fewer players than k
+    metrics = rank_grader.session_metrics([session(['A', 'B'], []), session(['A', 'B'], ['A', 'B']), session(['A', 'B', 'C', 'D'], ['B'])])
+    assert math.isnan(metrics['percentile_rank'][0]) and math.isnan(metrics['auc'][0]) and math.isnan(metrics['r_precision'][0])
+    assert math.isnan(metrics['auc'][1]) and metrics['r_precision'][1] == 1.0
+    assert math.isnan(metrics['precision@3'][0]) and metrics['precision@3'][2] == pytest.approx(1 / 3)
+
+def test_summarize_pairs_on_file_name():
+    # the session number the model wrote is not used to pair named and anonymized rankings
+    named = dict(session(['A', 'B'], ['A'], 'session_3'), session=99)
+    anonymized = dict(session(['Player_B', 'Player_A'], ['Player_A'], 'session_3_anonymized'), names_changed=True)
+    summary = rank_grader.summarize(rank_grader.session_metrics([named, anonymized]), n_boot=10)
+    difference = summary[(summary['condition'] == 'anonymized - named') & (summary['metric'] == 'auc')].iloc[0]
+    assert difference['n'] == 1 and difference['mean'] == pytest.approx(-1.0)
+
+# names before 'Rank:' and on the mafia line are not ranks, for the grader and the ranker alike
+def test_ranking_ignores_preamble_and_mafia_line():
+    import player_ranker
+    players = {'Player_A': 'mafia', 'Player_B': 'town', 'Player_C': 'town'}
+    response = "Player_A seems honest, Player_C less so.\nRank:\nPlayer_B\nPlayer_C\nPlayer_A\n\nActualy likely to be Mafia: Player_A"
+    block = ["File: session_1_anonymized.txt"] + response.split("\n") + [str(players)]
+    assert rank_grader.parse_block(block)['ranks'] == ['Player_B', 'Player_C', 'Player_A']
+    assert player_ranker.response_ranking(response, players) == (['Player_B', 'Player_C', 'Player_A'], {'Player_A'})
+
+def test_ranking_without_markers():
+    assert rank_grader.response_ranking("C then A", ['A', 'B', 'C']) == (['C', 'A', 'B'], set())
+
+@pytest.mark.parametrize('options', [[], ['--metrics']])
+def test_missing_ranks_file(tmp_path, capsys, options):
+    import argparse
+    parser = argparse.ArgumentParser()
+    rank_grader.add_arguments(parser)
+    rank_grader.run_command(parser.parse_args([str(tmp_path)] + options))
+    assert f"Error: 'ranks.txt' file not found in {tmp_path}" in capsys.readouterr().out
@@ -0,0 +1,85 @@
+# Tests of the response cache and how the rankers use it
+
+import os
+import pytest
+import backends
+import player_ranker
+from response_cache import ResponseCache, cache_key
+
+
+# a fake model server with an installed model (so responses are cached) that counts the prompts it answers
+class CountingBackend(backends.FakeBackend):
+    supports_batch = False
+
+    def __init__(self, digest='sha256:1', **settings):
+        super().__init__(**settings)
+        self.digest = digest
+        self.prompts = 0
+
+    def model_digest(self, model_name):
+        return self.digest
+
+    def generate(self, model_name, prompt, keep_alive=None, options=None):
+        self.prompts += 1
+        return super().generate(model_name, prompt, keep_alive, options)
+
+def rank(transcripts, backend, cache, **settings):
+    player_ranker.ollama_rank('fake', transcripts, backend=backend, cache=cache, **settings)
+    with open(os.path.join(transcripts, 'ranks.txt')) as ranks_file:
+        return ranks_file.read()
+
+def test_options_are_part_of_the_key():
+    assert cache_key('model', 'digest', 'prompt') == cache_key('model', 'digest', 'prompt', {})
+    assert cache_key('model', 'digest', 'prompt', {'num_ctx': 2048}) != cache_key('model', 'digest', 'prompt')
+    assert cache_key('model', 'digest', 'prompt', {'num_ctx': 2048}) != cache_key('model', 'digest', 'prompt', {'num_ctx': 4096})
+    assert cache_key('model', 'digest', 'prompt', {'seed': 1, 'temperature': 0.8}) == cache_key('model', 'digest', 'prompt', {'temperature': 0.8, 'seed': 1})
+
+def test_responses_are_saved_per_options(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'))
+    cache.put('model', 'digest', 'prompt', 'small window', {'num_ctx': 2048})
+    assert cache.get('model', 'digest', 'prompt', {'num_ctx': 2048}) == 'small window'
+    assert cache.get('model', 'digest', 'prompt', {'num_ctx': 4096}) is None
+    assert cache.get('model', 'digest', 'prompt') is None
+    cache.close()
+
+def test_sampled_rankings_are_saved_apart(tmp_path):
+    cache = player_ranker.CacheSettings(str(tmp_path / 'responses.sqlite'))
+    backend = backends.FakeBackend()
+    single = player_ranker.ModelRanker('fake', backend, cache, pull=False, options={'num_ctx': 2048})
+    sampled = player_ranker.ModelRanker('fake', backend, cache, player_ranker.SampleSettings(seed=1), pull=False, options={'num_ctx': 2048})
+    assert single.cache_options() == {'num_ctx': 2048}
+    assert sampled.cache_options()['num_ctx'] == 2048
+    assert sampled.cache_options() != player_ranker.ModelRanker('fake', backend, cache, player_ranker.SampleSettings(seed=2), pull=False).cache_options()
+    single.close()
+    sampled.close()
+
+# a second run answers every prompt from the cache, and a refresh asks the model again
+def test_cache_hit_and_refresh(small_transcripts, tmp_path):
+    cache = player_ranker.CacheSettings(str(tmp_path / 'responses.sqlite'))
+    transcripts = len(player_ranker.transcript_list(small_transcripts))
+    backend = CountingBackend()
+    ranks = rank(small_transcripts, backend, cache)
+    assert backend.prompts == transcripts
+    backend = CountingBackend()
+    assert rank(small_transcripts, backend, cache) == ranks
+    assert backend.prompts == 0
+    backend = CountingBackend()
+    assert rank(small_transcripts, backend, player_ranker.CacheSettings(cache.path, refresh=True)) == ranks
+    assert backend.prompts == transcripts
+
+# the model is only pulled when a prompt is not saved, and the prompts are looked up again for the model it pulled
+@pytest.mark.parametrize('pulled, asked', [('sha256:1', False), ('sha256:2', True)])
+def test_pull_on_a_miss(small_transcripts, tmp_path, pulled, asked):
+    cache = player_ranker.CacheSettings(str(tmp_path / 'responses.sqlite'))
+    rank(small_transcripts, CountingBackend(), cache)
+
+    class Pulls(CountingBackend):
+        def pull(self, model_name):
+            self.digest = pulled
+    backend = Pulls()
+    rank(small_transcripts, backend, cache)
+    assert backend.prompts == 0 and backend.digest == 'sha256:1' # every prompt saved, so nothing pulled
+    backend = Pulls(digest='sha256:0')
+    rank(small_transcripts, backend, cache)
+    assert backend.digest == pulled
+    assert backend.prompts == (len(player_ranker.transcript_list(small_transcripts)) if asked else 0)
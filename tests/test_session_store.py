@@ -0,0 +1,36 @@
+# Tests of the session store: it gives back the transcripts and players the transcript files have
+
+import os
+import io
+import contextlib
+import player_ranker
+import session_store
+
+
+def test_store_round_trip(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    store_path = str(tmp_path / 'store')
+    with contextlib.redirect_stdout(io.StringIO()):
+        session_store.ingest(small_dataset, transcripts, store_path)
+    store = session_store.SessionStore(store_path)
+    names = player_ranker.transcript_list(transcripts)
+    assert store.transcript_names() == names
+    for name in names:
+        with open(os.path.join(transcripts, name)) as file:
+            lines = file.readlines()
+        session, anonymized, round_number = session_store.parse_transcript_name(name)
+        assert store.transcript(session, anonymized, round_number) == ''.join(lines[:-1]), name
+        assert store.players(session, anonymized, round_number) == player_ranker.parse_players(lines[-1].strip()), name
+
+# a store that is up to date is left as it is, and an empty dataset makes an empty store
+def test_ingest_again(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    store_path = str(tmp_path / 'store')
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        session_store.ingest(small_dataset, transcripts, store_path)
+        session_store.ingest(small_dataset, transcripts, store_path)
+        session_store.ingest(str(tmp_path / 'empty'), str(tmp_path / 'empty_transcripts'), str(tmp_path / 'empty_store'))
+        session_store.ingest(str(tmp_path / 'empty'), str(tmp_path / 'empty_transcripts'), str(tmp_path / 'empty_store'))
+    assert "Session store up to date: 3 sessions" in output.getvalue()
+    assert "Session store up to date: 0 sessions, 0 rounds" in output.getvalue()
@@ -0,0 +1,127 @@
+# Tests of transcript building: the vectorized formatting and the manifest's staleness check
+
+import os
+import io
+import shutil
+import contextlib
+import pandas as pd
+import pytest
+import benchmarks
+import transcript_maker
+
+
+def session_logs(folder):
+    for session in transcript_maker.session_directories(folder):
+        log = pd.read_csv(os.path.join(session, 'info.csv')).sort_values(by='creation_time')
+        yield session, log, transcript_maker.generate_names(log)
+
+# line_table gives the row by row formatting's lines byte for byte, on the dataset and on an enlarged copy of it
+@pytest.mark.parametrize('scale', [1, 3])
+def test_line_table_matches_row_by_row_formatting(tmp_path, dataset_folder, scale):
+    folder = dataset_folder
+    if scale > 1:
+        folder = benchmarks.enlarged_dataset(dataset_folder, scale, str(tmp_path / 'enlarged'))
+    for session, log, aliases in session_logs(folder):
+        lines, anonymized = benchmarks.reference_lines(log, aliases)
+        table = transcript_maker.line_table(log, aliases)
+        assert table['line'].tolist() == lines, session
+        assert table['anonymized_line'].tolist() == anonymized, session
+
+def test_line_table_odd_rows():
+    log = pd.DataFrame({
+        'type': ['vote', 'vote', 'text', 'text', 'info'],
+        'contents': ['Ann: Bob', 'Ann: Bob: Cy', 'Bob: hi: there', 'no separator', 'Phase Change to Daytime'],
+    })
+    aliases = {'Ann': 'Player_A'}
+    table = transcript_maker.line_table(log, aliases)
+    lines, anonymized = benchmarks.reference_lines(log, aliases)
+    assert table['line'].tolist() == lines
+    assert table['anonymized_line'].tolist() == anonymized
+    assert table['anonymized_line'][0] == 'Player_A votes for silent_player!'
+    assert table['speaker'][0] == 'Ann' and pd.isna(table['speaker'][1]) and table['speaker'][2] == 'Bob'
+    assert table['message'][2] == 'hi: there'
+
+# an enlarged dataset keeps every round of the games
+def test_enlarged_dataset_keeps_rounds(tmp_path, dataset_folder):
+    folder = benchmarks.enlarged_dataset(dataset_folder, 3, str(tmp_path / 'enlarged'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for original, enlarged in zip(transcript_maker.session_directories(dataset_folder),
+                                      transcript_maker.session_directories(folder)):
+            assert (len(list(transcript_maker.extract_rounds(original, 1, seed=1)))
+                    == len(list(transcript_maker.extract_rounds(enlarged, 1, seed=1))))
+
+
+def plan(dataset, transcripts, force=False, max_rounds=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        manifest, directories, jobs = transcript_maker.plan_sessions(dataset, transcripts, force, max_rounds)
+    return jobs
+
+def build(dataset, transcripts, max_rounds=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        transcript_maker.process_transmissions(dataset, transcripts, max_rounds=max_rounds)
+
+def test_manifest_up_to_date(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    assert len(plan(small_dataset, transcripts)) == 3
+    build(small_dataset, transcripts)
+    assert plan(small_dataset, transcripts) == []
+    assert len(plan(small_dataset, transcripts, force=True)) == 3
+
+def test_manifest_changed_source(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    build(small_dataset, transcripts)
+    key = sorted(transcript_maker.read_manifest(transcripts)['sessions'])[1]
+    with open(os.path.join(small_dataset, key, 'info.csv'), 'a') as f:
+        f.write('\n')
+    assert plan(small_dataset, transcripts) == [key]
+
+def test_manifest_touched_source_is_not_stale(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    build(small_dataset, transcripts)
+    key = sorted(transcript_maker.read_manifest(transcripts)['sessions'])[0]
+    os.utime(os.path.join(small_dataset, key, 'node.csv'))
+    assert plan(small_dataset, transcripts) == []
+
+def test_manifest_missing_output(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    build(small_dataset, transcripts)
+    entries = transcript_maker.read_manifest(transcripts)['sessions']
+    key = sorted(entries)[2]
+    os.remove(os.path.join(transcripts, entries[key]['outputs'][-1]))
+    assert plan(small_dataset, transcripts) == [key]
+
+def test_manifest_rounds_or_version_change_rebuilds_all(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    build(small_dataset, transcripts)
+    assert len(plan(small_dataset, transcripts, max_rounds=1)) == 3
+    build(small_dataset, transcripts, max_rounds=1)
+    manifest = transcript_maker.read_manifest(transcripts)
+    manifest['version'] = transcript_maker.manifest_version - 1
+    transcript_maker.write_manifest(transcripts, manifest)
+    assert len(plan(small_dataset, transcripts, max_rounds=1)) == 3
+
+def test_manifest_removed_session(small_dataset, tmp_path):
+    transcripts = str(tmp_path / 'transcripts')
+    build(small_dataset, transcripts)
+    entries = transcript_maker.read_manifest(transcripts)['sessions']
+    key = sorted(entries)[0]
+    outputs = entries[key]['outputs']
+    numbers = {other: entries[other]['session'] for other in entries}
+    shutil.rmtree(os.path.join(small_dataset, key))
+    build(small_dataset, transcripts)
+    entries = transcript_maker.read_manifest(transcripts)['sessions']
+    assert key not in entries
+    assert not any(os.path.exists(os.path.join(transcripts, output)) for output in outputs)
+    # the other sessions keep their numbers
+    assert {other: entry['session'] for other, entry in entries.items()} == {other: numbers[other] for other in entries}
+
+# a player has one alias in every round of a game, and an alias names one player
+def test_aliases_are_the_same_in_every_round(dataset_folder):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for session in transcript_maker.session_directories(dataset_folder):
+            rounds = list(transcript_maker.extract_rounds(session, 1, seed=7))
+            named = {}
+            for round_number, lines, player_roles, anonymized_player_roles, aliases in rounds:
+                assert set(anonymized_player_roles) == {aliases[name] for name in player_roles}
+                for name in player_roles:
+                    assert named.setdefault(aliases[name], name) == name, session
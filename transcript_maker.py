@@ -1,28 +1,40 @@
 import os
-import pandas as pd
+import re
+import json
+import hashlib
+import argparse
+import tempfile
 import random
 import string
+import instrumentation
+# numpy, pandas and the process pool are imported by the functions that use them, so importing this module is quick and does nothing
 
 dataset_folder = './dataset'
 transcripts_folder = './transcripts'
-os.makedirs(transcripts_folder, exist_ok=True)
+
+# the manifest records what each transcript was built from (see process_transmissions)
+manifest_name = 'manifest.json'
+# bump this when the transcript format changes, so every session is rebuilt
+manifest_version = 3
+source_files = ('info.csv', 'node.csv')
+
+# Returns the sorted names of the players who speak or vote in the session data
+# (the name is everything before the first ': ' of the contents of 'text' and 'vote' rows)
+def spoken_names(session_data):
+    spoken = session_data.loc[session_data['type'].isin(['text', 'vote']), 'contents'].dropna()
+    return sorted(set(spoken.str.split(': ', n=1).str[0]))
 
 # Generate a dictionary mapping unique player names to aliases.
-def generate_names(session_data):
+# rng is the random number generator used to shuffle the alias letters
+def generate_names(session_data, rng=random):
     
     # Extract all unique names from rows where type is 'text' or 'vote'
-    unique_names = set()
-    for _, row in session_data.iterrows():
-        if row['type'] in {'text', 'vote'}:
-            try:
-                player_name = row['contents'].split(': ')[0]
-                unique_names.add(player_name)
-            except IndexError:
-                pass  # Skip rows with unexpected format
+    # (sorted, so the same seed gives the same aliases in every process)
+    unique_names = spoken_names(session_data)
 
     #create list of randomly sorted letters
     available_letters = list(string.ascii_uppercase)
-    random.shuffle(available_letters)
+    rng.shuffle(available_letters)
     
     # Create aliases in the format "Player_{letter}" and assign them to each unique name
     aliases = {}
@@ -39,9 +51,11 @@ def generate_names(session_data):
 #   Player aliases with their role
 #Given 
 #   aliases dictionary and
-#   node.csv path
-def find_roles(aliases, node_path):
-    node_data = pd.read_csv(node_path) # read node.csv
+#   node.csv path (or its data, already read)
+def find_roles(aliases, node_path, node_data=None):
+    import pandas as pd
+    if node_data is None:
+        node_data = pd.read_csv(node_path) # read node.csv
     # List of players that have the 'mafioso' role
     mafia_list = node_data[node_data['type']=='mafioso']['property1'].to_list()
     # List of aliases of players that have the 'mafioso' role
@@ -54,105 +68,373 @@ def find_roles(aliases, node_path):
 
     return player_roles, anonymized_player_roles
 
-def process_transmissions(dataset_folder, transcripts_folder):
-    session_num = 1  # Start numbering transcripts
-    
-    # Iterate over each subdirectory in the dataset folder
+# Returns the phase changes of the sorted data as (positions, phases, repeats):
+#   positions, phases: where the phase changes and to what ('Daytime' or 'Nighttime'), in order
+#   repeats: positions of phase change rows that announce the phase already announced by the one before them
+#            (the logs often have the same change two or more times in a row), which are left out of positions
+def phase_boundaries(data):
+    import numpy as np
+    import pandas as pd
+    # one pass over the contents finds every marker
+    phases = data['contents'].str.extract(r'Phase Change to (Daytime|Nighttime)', expand=False).to_numpy(dtype=object)
+    positions = np.flatnonzero(pd.notna(phases))
+    announced = phases[positions]
+    repeated = np.zeros(len(positions), dtype=bool)
+    repeated[1:] = announced[1:] == announced[:-1]
+    return positions[~repeated], announced[~repeated], positions[repeated]
+
+# Returns the (start, end) positions in the sorted data of every round of the game:
+# each "Phase Change to Daytime" row and the "Phase Change to Nighttime" row that ends it
+# a daytime the log never ends (the last one, if the game stopped during the day) is not a round
+def find_rounds(positions, phases):
+    import numpy as np
+    # once the repeats are gone the changes alternate, so a daytime is ended by the change right after it
+    daytimes = np.flatnonzero(phases[:-1] == 'Daytime')
+    return list(zip(positions[daytimes].tolist(), positions[daytimes + 1].tolist()))
+
+# Returns a table with one row per line of the session data:
+#   kind: the row type ('text', 'vote', 'info', ...)
+#   speaker, target, message: who spoke or voted, who they voted for, what they said (missing if not applicable)
+#   line, anonymized_line: the regular and anonymized transcript lines
+#       votes are written "{player_voting} votes for {player_voted}!"
+#       chat messages are written "{player}: {message}"
+#       anything else (or a vote/message without the expected format) is written as is
+def line_table(session_data, aliases):
+    import numpy as np
+    import pandas as pd
+    contents = session_data['contents']
+    row_type = session_data['type']
+    # the columns are filled in as plain arrays, which is much cheaper than masked Series assignment
+    transcript_lines = contents.to_numpy(dtype=object, copy=True)
+    anonymized_lines = transcript_lines.copy()
+    speakers = np.full(len(contents), None, dtype=object)
+    targets = speakers.copy()
+    messages = speakers.copy()
+
+    # every vote is saved as "{player_voting} votes for {player_voted}!"
+    votes = ((row_type == 'vote') & (contents.str.count(': ') == 1)).to_numpy()
+    if votes.any():
+        vote_parts = contents[votes].str.split(': ', expand=True)
+        player_voting, player_voted = vote_parts[0], vote_parts[1]
+        speakers[votes] = player_voting.to_numpy(dtype=object)
+        targets[votes] = player_voted.to_numpy(dtype=object)
+        transcript_lines[votes] = (player_voting + ' votes for ' + player_voted + '!').to_numpy(dtype=object)
+        anonymized_lines[votes] = (player_voting.map(aliases).fillna('silent_player') + ' votes for '
+                                   + player_voted.map(aliases).fillna('silent_player') + '!').to_numpy(dtype=object)
+
+    # every chat message is saved as "{player}: {message}" (already the format of the contents)
+    texts = ((row_type == 'text') & contents.str.contains(': ', regex=False, na=False)).to_numpy()
+    if texts.any():
+        text_parts = contents[texts].str.split(': ', n=1, expand=True)
+        player, message = text_parts[0], text_parts[1]
+        speakers[texts] = player.to_numpy(dtype=object)
+        messages[texts] = message.to_numpy(dtype=object)
+        anonymized_lines[texts] = (player.map(aliases).fillna(player) + ': ' + message).to_numpy(dtype=object)
+
+    return pd.DataFrame({
+        'kind': row_type.to_numpy(dtype=object),
+        'speaker': speakers,
+        'target': targets,
+        'message': messages,
+        'line': transcript_lines,
+        'anonymized_line': anonymized_lines,
+    })
+
+# Returns the sorted list of session directories (those with an info.csv) in the dataset folder
+# on a fresh build a session's number is its place in this list, so it only depends on the directory names
+def session_directories(dataset_folder):
+    directories = []
     for root, dirs, files in os.walk(dataset_folder):
         if 'info.csv' in files:
-            csv_path = os.path.join(root, 'info.csv')
-            print('info.csv found at ' + csv_path)
-            data = pd.read_csv(csv_path)
-            
-            # Ensure data is sorted by creation_time to process chronologically
-            data = data.sort_values(by='creation_time')
-            
-            # Filter rows where 'contents' contains the phase change markers
-            daytime_rows = data[data['contents'].str.contains("Phase Change to Daytime", na=False)]
-            nighttime_rows = data[data['contents'].str.contains("Phase Change to Nighttime", na=False)]
-            
-            # If both daytime and nighttime transitions are found
-            if not daytime_rows.empty and not nighttime_rows.empty:
-                
-                # Get the index of the first "Phase Change to Daytime" row
-                daytime_start = daytime_rows.index[0]
-                print('  start time: ', daytime_start)
-                
-                # Try to find the next "Phase Change to Nighttime" after daytime_start
-                nighttime_candidates = nighttime_rows[nighttime_rows.index > daytime_start]
-                if not nighttime_candidates.empty:
-                    
-                    # Get the first nighttime index after the daytime_start
-                    nighttime_end = nighttime_candidates.index[0]
-                    print('  end time: ', nighttime_end)
-                    
-                    # Select rows within this daytime-to-nighttime range
-                    session_data = data.loc[daytime_start:nighttime_end]
-                    
-                    # Generate aliases for players in this session
-                    aliases = generate_names(session_data)
-
-                    # Prepare list of lines for both transcripts (regular and anonymized)
-                    transcript_lines = []
-                    anonymized_lines = []
-                    
-                    ## transcribing data to formated strings ##
-                    # iterate through data contents
-                    for _, row in session_data.iterrows():
-                        
-                        # every vote is saved as "{player_voting} votes for {player_voted}!"
-                        if row['type'] == 'vote':
-                            try:
-                                player_voting, player_voted = row['contents'].split(': ')
-                                formatted_content = f"{player_voting} votes for {player_voted}!"
-                                anonymized_content = f"{aliases.get(player_voting, 'silent_player')} votes for {aliases.get(player_voted, 'silent_player')}!"
-                            except ValueError:
-                                formatted_content = anonymized_content = row['contents']
-                        
-                        # every chat message is saved as "{player}: {message}"
-                        elif row['type'] == 'text':
-                            try:
-                                player, message = row['contents'].split(': ', 1)
-                                formatted_content = f"{player}: {message}"
-                                anonymized_content = f"{aliases.get(player, player)}: {message}"
-                            except ValueError:
-                                formatted_content = anonymized_content = row['contents']
-                        
-                        # Use original content for other types
-                        else:
-                            formatted_content = anonymized_content = row['contents']
-                        
-                        # save formatted content to list of lines. (for txt transcript later)
-                        transcript_lines.append(formatted_content)
-                        anonymized_lines.append(anonymized_content)
-                    
-                    # Player dictionary with names and roles
-                    mafia_names, mafia_aliases = find_roles(aliases, os.path.join(root, 'node.csv'))
-
-                    # Join all lines into single transcript texts and add the list of players at the bottom
-                    transcript = '\n'.join(transcript_lines) + f'\nPlayers: {[ f"{name}:{role}" for name, role in mafia_names.items() ]}'
-                    anonymized_transcript = '\n'.join(anonymized_lines) + f'\nPlayers: {[ f"{name}:{role}" for name, role in mafia_aliases.items() ]}'
-                    
-                    # Write the regular transcript
-                    transcript_path = os.path.join(transcripts_folder, f'session_{session_num}.txt')
-                    with open(transcript_path, 'w') as f:
-                        f.write(transcript)
-                    print(f'Transcript created: session_{session_num}.txt')
-                    
-                    # Write the anonymized transcript
-                    anonymized_transcript_path = os.path.join(transcripts_folder, f'session_{session_num}_anonymized.txt')
-                    with open(anonymized_transcript_path, 'w') as f:
-                        f.write(anonymized_transcript)
-                    print(f'Anonymized transcript created: session_{session_num}_anonymized.txt')
-                    
-                    # Increment session number for the next file
-                    session_num += 1
-                else:
-                    print(f"No 'Nighttime' phase found after 'Daytime' in session {session_num}")
-                
-            else:
-                print(f"Skipping session {session_num}: incomplete daytime/nighttime markers")
-
-    print(f"Process complete! See {transcripts_folder} for results.")
-
-process_transmissions(dataset_folder, transcripts_folder)
\ No newline at end of file
+            directories.append(root)
+    return sorted(directories)
+
+# Writes text to a file in one step: the text goes to a temporary file that then replaces the target,
+# so a reader never sees a half written transcript
+def write_atomic(path, text):
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as f:
+            f.write(text)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+# Returns the manifest saved in the transcripts folder (an empty one if there is none)
+def read_manifest(transcripts_folder):
+    manifest_path = os.path.join(transcripts_folder, manifest_name)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    return {'version': manifest_version, 'sessions': {}}
+
+def write_manifest(transcripts_folder, manifest):
+    write_atomic(os.path.join(transcripts_folder, manifest_name), json.dumps(manifest, indent=1, sort_keys=True))
+
+# Returns the mtime, size and sha256 hash of each source file of a session directory
+# files whose mtime and size match the previous state keep their previous hash instead of being read again
+def source_state(root, previous=None):
+    previous = previous or {}
+    state = {}
+    for name in source_files:
+        path = os.path.join(root, name)
+        if not os.path.isfile(path):
+            state[name] = None
+            continue
+        stat = os.stat(path)
+        known = previous.get(name)
+        if known and known['mtime'] == stat.st_mtime_ns and known['size'] == stat.st_size:
+            file_hash = known['sha256']
+        else:
+            with open(path, 'rb') as f:
+                file_hash = hashlib.sha256(f.read()).hexdigest()
+        state[name] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_hash}
+    return state
+
+# True if a session in the manifest must be built again: changed sources or missing outputs
+def is_stale(entry, state, transcripts_folder, rebuild_all):
+    if rebuild_all:
+        return True
+    for name in source_files:
+        old, new = entry['sources'].get(name), state[name]
+        if (old is None) != (new is None) or (old and old['sha256'] != new['sha256']):
+            return True
+    return not all(os.path.isfile(os.path.join(transcripts_folder, output)) for output in entry['outputs'])
+
+# Reads one session directory and yields (round, lines, player_roles, anonymized_player_roles, aliases) for each round
+# of the game (its days, see find_rounds), in order:
+#   round: the round number (1 for the first day)
+#   lines: the line_table of the round, without the repeated phase change rows
+#   player_roles, anonymized_player_roles: the dictionaries of find_roles for the players who speak or vote in the round
+#   aliases: the aliases of the whole game, so a player has the same alias in every round
+# The log is read and sorted once, its phase changes are found in one pass, and each round is sliced out of it,
+# so a game takes the same time however many rounds it has. Only one round's lines are built at a time.
+# max_rounds: stop after this many rounds (None for every round)
+# seed fixes the random aliases (None for new random aliases)
+def extract_rounds(root, session_num, seed=None, max_rounds=None):
+    import numpy as np
+    import pandas as pd
+    csv_path = os.path.join(root, 'info.csv')
+    print('info.csv found at ' + csv_path)
+    with instrumentation.span('csv load'):
+        data = pd.read_csv(csv_path)
+    
+    with instrumentation.span('session slicing'):
+        # Ensure data is sorted by creation_time to process chronologically
+        data = data.sort_values(by='creation_time')
+        
+        # Find every daytime phase and the nighttime that ends it
+        positions, phases, repeats = phase_boundaries(data)
+        rounds = find_rounds(positions, phases)
+        keep = np.ones(len(data), dtype=bool)
+        keep[repeats] = False
+    
+    if not rounds:
+        print(f"Skipping session {session_num}: incomplete daytime/nighttime markers")
+        return
+    if max_rounds is not None:
+        rounds = rounds[:max_rounds]
+
+    with instrumentation.span('aliasing'):
+        # one alias for each player of the game, drawn from every spoken row of the log, so a player keeps it
+        # from round to round whatever rounds are built (the generator is the session's own, so worker processes
+        # don't share a random state)
+        aliases = generate_names(data[keep], random.Random(seed))
+
+    node_data = None
+    for round_number, (daytime_start, nighttime_end) in enumerate(rounds, 1):
+        print(f'  round {round_number} start time: ', data.index[daytime_start])
+        print(f'  round {round_number} end time: ', data.index[nighttime_end])
+
+        with instrumentation.span('session slicing'):
+            # Select rows within this daytime-to-nighttime range
+            session_data = data.iloc[daytime_start:nighttime_end + 1][keep[daytime_start:nighttime_end + 1]]
+        
+        with instrumentation.span('aliasing'):
+            ## transcribing data to formated strings (regular and anonymized) ##
+            lines = line_table(session_data, aliases)
+        
+        # Player dictionary with names and roles, for the players of this round
+        with instrumentation.span('roles'):
+            if node_data is None:
+                node_data = pd.read_csv(os.path.join(root, 'node.csv'))
+            round_aliases = {name: aliases[name] for name in spoken_names(session_data)}
+            mafia_names, mafia_aliases = find_roles(round_aliases, os.path.join(root, 'node.csv'), node_data)
+        yield round_number, lines, mafia_names, mafia_aliases, aliases
+
+# Reads one session directory and returns (lines, player_roles, anonymized_player_roles, aliases) of its first round
+# (see extract_rounds), or None if the session has no complete daytime
+def extract_session(root, session_num, seed=None):
+    for round_number, lines, mafia_names, mafia_aliases, aliases in extract_rounds(root, session_num, seed, max_rounds=1):
+        return lines, mafia_names, mafia_aliases, aliases
+    return None
+
+# returns the transcript file name of a round: the first round keeps the name a session's transcript has always had
+# ('session_12.txt'), later rounds add their number ('session_12_round_3.txt')
+def transcript_file_name(session_num, round_number=1, anonymized=False):
+    name = f'session_{session_num}' if round_number == 1 else f'session_{session_num}_round_{round_number}'
+    return name + ('_anonymized.txt' if anonymized else '.txt')
+
+session_pattern = re.compile(r'session_(\d+)')
+# returns the session number of a transcript file name (such as 12 for 'session_12_round_3_anonymized.txt')
+def transcript_session(file_name):
+    return int(session_pattern.search(os.path.basename(file_name)).group(1))
+
+round_pattern = re.compile(r'_round_(\d+)')
+# returns the round number of a transcript file name (1 for a name without one)
+def transcript_round(file_name):
+    match = round_pattern.search(os.path.basename(file_name))
+    return int(match.group(1)) if match else 1
+
+# Writes lines to a file, one after another, in one step (like write_atomic)
+# the text is never joined in memory, so writing takes no more memory than the lines themselves
+def write_lines_atomic(path, lines, last_line):
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w', buffering=1 << 16) as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+            f.write(last_line)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+# Writes the regular and anonymized transcripts of every round of one session directory (see extract_rounds)
+# returns the names of the files written (none if the session was skipped)
+# seed fixes the random aliases (None for new random aliases), max_rounds limits the rounds written (None for all)
+# keep_rounds=True returns (names, rounds) instead, where rounds has what extract_rounds yielded for each round,
+# so a caller that needs the rounds too (such as session_store.ingest) does not read the session again
+def process_session(root, session_num, transcripts_folder, seed=None, max_rounds=None, keep_rounds=False):
+    written = []
+    rounds = []
+    for extracted in extract_rounds(root, session_num, seed, max_rounds):
+        round_number, lines, mafia_names, mafia_aliases, aliases = extracted
+        if keep_rounds:
+            rounds.append(extracted)
+        # the lines of the transcript, with the list of players at the bottom
+        regular_name = transcript_file_name(session_num, round_number)
+        anonymized_name = transcript_file_name(session_num, round_number, anonymized=True)
+        
+        # Write the regular transcript
+        instrumentation.count('transcripts written', 2)
+        write_lines_atomic(os.path.join(transcripts_folder, regular_name), lines['line'],
+                           f'Players: {[ f"{name}:{role}" for name, role in mafia_names.items() ]}')
+        print(f'Transcript created: {regular_name}')
+        
+        # Write the anonymized transcript
+        write_lines_atomic(os.path.join(transcripts_folder, anonymized_name), lines['anonymized_line'],
+                           f'Players: {[ f"{name}:{role}" for name, role in mafia_aliases.items() ]}')
+        print(f'Anonymized transcript created: {anonymized_name}')
+        written += [regular_name, anonymized_name]
+    return (written, rounds) if keep_rounds else written
+
+# Works out which sessions of the dataset folder need building (see process_transmissions)
+# the transcripts of deleted session directories are removed, and new sessions are given numbers and seeds
+# returns (manifest, directories, jobs): the updated manifest (not yet written), the session directories by key
+# and the keys of the sessions to build, in order
+# max_rounds: the rounds of each game to write (None for all), a change of it rebuilds every session
+def plan_sessions(dataset_folder, transcripts_folder, force=False, max_rounds=None):
+    os.makedirs(transcripts_folder, exist_ok=True)
+    manifest = read_manifest(transcripts_folder)
+    entries = manifest['sessions']
+    rebuild_all = force or manifest.get('version') != manifest_version or manifest.get('max_rounds') != max_rounds
+    manifest['max_rounds'] = max_rounds
+
+    # sessions are keyed by their directory within the dataset folder
+    directories = {os.path.relpath(root, dataset_folder): root for root in session_directories(dataset_folder)}
+
+    # remove the transcripts of sessions whose directory is gone
+    for key in [key for key in entries if key not in directories]:
+        for output in entries[key]['outputs']:
+            output_path = os.path.join(transcripts_folder, output)
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+        print(f"Removed session {entries[key]['session']}: {key} no longer exists")
+        del entries[key]
+
+    # New sessions are numbered after the existing ones (in sorted order), so old numbers never shift
+    # and the numbering does not depend on which worker finishes first
+    next_num = max([entry['session'] for entry in entries.values()], default=0) + 1
+    jobs = []
+    for key, root in directories.items():
+        entry = entries.get(key)
+        if entry is None:
+            state = source_state(root)
+            entries[key] = {'session': next_num, 'seed': random.randrange(2 ** 32), 'sources': state, 'outputs': []}
+            next_num += 1
+            jobs.append(key)
+        else:
+            state = source_state(root, entry['sources'])
+            if is_stale(entry, state, transcripts_folder, rebuild_all):
+                jobs.append(key)
+            entry['sources'] = state
+    print(f"{len(jobs)} of {len(directories)} sessions to build")
+    return manifest, directories, jobs
+
+# Builds the given sessions (keys of the manifest's sessions) with process_session, in `workers` processes,
+# and records the transcripts written in the manifest (which is left to the caller to write)
+# returns what process_session returned for each session, in the order of keys
+def build_sessions(manifest, directories, keys, transcripts_folder, workers=1, max_rounds=None, keep_rounds=False):
+    entries = manifest['sessions']
+    arguments = [(directories[key], entries[key]['session'], transcripts_folder, entries[key]['seed'], max_rounds, keep_rounds) for key in keys]
+    if workers > 1 and len(keys) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_session, *zip(*arguments)))
+    else:
+        results = [process_session(*job) for job in arguments]
+
+    for key, result in zip(keys, results):
+        replace_outputs(transcripts_folder, entries[key], result[0] if keep_rounds else result)
+    manifest['version'] = manifest_version
+    return results
+
+# Records the transcripts written for a rebuilt session in its manifest entry
+# and removes those it had before that were not written again (rounds the session no longer has)
+def replace_outputs(transcripts_folder, entry, written):
+    for output in set(entry['outputs']) - set(written):
+        output_path = os.path.join(transcripts_folder, output)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+    entry['outputs'] = written
+
+# Writes the transcripts of every round of every session in the dataset folder (see process_session)
+# workers: number of processes that build sessions at the same time (1 = one after another)
+# max_rounds: only write the first max_rounds rounds of each game (None for all, 1 for the first day only)
+# Only sessions whose info.csv/node.csv changed (or whose transcripts are missing) are built again;
+# the manifest.json in the transcripts folder keeps, for every session directory,
+#   its session number, the seed of its aliases, the state of its source files and the transcripts built from them
+# so a rebuilt session keeps its number and aliases. force=True rebuilds everything.
+def process_transmissions(dataset_folder, transcripts_folder, workers=1, force=False, max_rounds=None):
+    manifest, directories, jobs = plan_sessions(dataset_folder, transcripts_folder, force, max_rounds)
+    entries = manifest['sessions']
+    build_sessions(manifest, directories, jobs, transcripts_folder, workers, max_rounds)
+    write_manifest(transcripts_folder, manifest)
+
+    written = sum(1 for entry in entries.values() if entry['outputs'])
+    rounds = sum(len(entry['outputs']) // 2 for entry in entries.values())
+    print(f"Process complete! {written} of {len(directories)} sessions written, {rounds} rounds ({len(jobs)} built this run). See {transcripts_folder} for results.")
+
+
+# command line usage:
+#   python transcript_maker.py --workers 8
+#   python mafia_eval.py build --workers 8
+command_description = "Write a transcript of every round (day) of every game in the dataset"
+
+def add_arguments(parser):
+    parser.add_argument('dataset_folder', nargs='?', default=dataset_folder)
+    parser.add_argument('transcripts_folder', nargs='?', default=transcripts_folder)
+    parser.add_argument('--workers', type=int, default=1, help="sessions built in parallel processes")
+    parser.add_argument('--force', action='store_true', help="rebuild every session, not just the changed ones")
+    parser.add_argument('--rounds', type=int, default=None, help="only write the first N rounds of each game (default: all)")
+
+def run_command(args):
+    process_transmissions(args.dataset_folder, args.transcripts_folder, workers=args.workers, force=args.force, max_rounds=args.rounds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=command_description)
+    add_arguments(parser)
+    run_command(parser.parse_args())